@@ -81,6 +81,13 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 # EMAIL_HOST_USER = 'no_reply_renty@zohomail.eu'
 # EMAIL_HOST_PASSWORD = 'wui3fWCa3dEM'
 
+# Emails are queued in the outbox and sent by `manage.py send_outbox`, failed
+# emails are retried after OUTBOX_RETRY_DELAY seconds doubling on every attempt
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_POLL_INTERVAL = 2
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -159,6 +166,9 @@ USE_TZ = True
 STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
+# Uploads are decoded in memory, anything left in MEDIA_ROOT longer than this
+# is removed by manage.py expire_media
+MEDIA_EXPIRY = 60 * 60 * 24
 
 REF_ROOT = os.path.join(BASE_DIR, 'database/')
 REF_URL = '/database/'
@@ -171,3 +181,92 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 FORGOT_PASSWORD_PREFIX = "forgot-password"
 CONFIRM_ACCOUNT_PREFIX = "confirm-account"
 SET_ATTENDANCE = "attendance-token"
+
+# Run the OpenCV Haar cascade before MTCNN, its faces are used when their
+# level weight reaches DETECTOR_FAST_CONFIDENCE, otherwise MTCNN runs. Faces
+# smaller than DETECTOR_FAST_MIN_SIZE of the shorter image side are ignored.
+# Off until its crops are shown to embed as close to the gallery as MTCNN's
+DETECTOR_CASCADE = False
+DETECTOR_FAST_CONFIDENCE = 3.0
+DETECTOR_FAST_MIN_SIZE = 0.125
+
+# Uploads are decoded with JPEG DCT scaling down to no less than
+# DECODE_MIN_SIDE pixels on the longer side, detection runs on a copy at most
+# DETECTION_MAX_SIDE pixels long and faces are cropped from the decoded image.
+# Group photos are detected at up to GROUP_DETECTION_MAX_SIDE so the small
+# faces of the back rows stay above the MTCNN minimum face size
+DECODE_MIN_SIDE = 1280
+DETECTION_MAX_SIDE = 640
+GROUP_DETECTION_MAX_SIDE = 4096
+
+# Face embedding backend: "api.embedders.DeepFaceEmbedder" runs ArcFace on
+# TensorFlow, "api.embedders.ONNXEmbedder" runs the ONNX model at
+# EMBEDDER_ONNX_MODEL on ONNX Runtime's CPU provider and
+# "api.embedders.StubEmbedder" returns deterministic embeddings for tests.
+# The ONNX model gets RGB pixels when EMBEDDER_ONNX_RGB is set, BGR otherwise,
+# normalized as (x - EMBEDDER_ONNX_MEAN) / EMBEDDER_ONNX_STD. The defaults
+# match DeepFace's ArcFace export, InsightFace models take RGB, 127.5 and 128
+EMBEDDER_BACKEND = "api.embedders.DeepFaceEmbedder"
+EMBEDDER_ONNX_MODEL = os.path.join(BASE_DIR, "models", "arcface.onnx")
+EMBEDDER_ONNX_RGB = False
+EMBEDDER_ONNX_MEAN = 0
+EMBEDDER_ONNX_STD = 255
+
+# Seconds attendance and account tokens stay valid
+TOKEN_MAX_AGE = 60 * 60 * 24 * 3
+
+# ArcFace cosine distance under which a gallery image counts as a match
+RECOGNITION_THRESHOLD = 0.68
+
+# Images accepted by one /recognition/batch/ request
+RECOGNITION_BATCH_MAX_IMAGES = 16
+
+# Gallery search backend, "exact" scans every embedding, "ivf" only scores
+# the rows under the GALLERY_IVF_PROBES nearest of GALLERY_IVF_LISTS centroids,
+# "prototype" re-ranks the images of the GALLERY_SHORTLIST closest students,
+# "int8" scans memory-mapped int8 codes and re-ranks the candidates within
+# GALLERY_QUANTIZATION_MARGIN of the threshold, at most GALLERY_RERANK when
+# only the k best are asked for, with the float32 embeddings. IVF centroids are
+# retrained once the gallery grows or shrinks by a factor of
+# GALLERY_IVF_RETRAIN_RATIO from the size they were trained on
+GALLERY_INDEX = "exact"
+GALLERY_SHORTLIST = 5
+GALLERY_IVF_LISTS = 256
+GALLERY_IVF_PROBES = 8
+GALLERY_IVF_RETRAIN_RATIO = 2
+GALLERY_RERANK = 50
+GALLERY_QUANTIZATION_MARGIN = 0.05
+
+# Images kept per student, a recognized image joins the gallery only when it
+# is at least GALLERY_MIN_DIVERSITY cosine distance from the student's images
+GALLERY_MAX_IMAGES = 20
+GALLERY_MIN_DIVERSITY = 0.1
+
+# Load the detector and embedder and run a warm up inference when a process
+# serves its first request, /health/ready answers 503 until that finishes,
+# opt in with PRELOAD_MODELS=1 in the server environment
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS") == "1"
+
+# Queue behind /recognition/?async=true, api.jobs.LocalQueue keeps jobs in
+# process with RECOGNITION_WORKERS threads, api.jobs.RedisQueue is drained by
+# manage.py recognition_worker
+RECOGNITION_QUEUE_BACKEND = "api.jobs.RedisQueue"
+RECOGNITION_QUEUE_LOCATION = "redis://127.0.0.1:6379"
+RECOGNITION_WORKERS = 2
+RECOGNITION_JOB_TTL = 60 * 60
+
+# Detection and embedding run in INFERENCE_PROCESSES spawned processes per web
+# worker, None shares the CPU cores between the INFERENCE_WEB_WORKERS pools
+# after dividing them by the intra op threads and 0 runs inference inside the
+# web worker, a call waiting on the pool gives up after INFERENCE_TIMEOUT
+# seconds
+INFERENCE_PROCESSES = None
+INFERENCE_INTRA_OP_THREADS = 2
+INFERENCE_INTER_OP_THREADS = 1
+INFERENCE_WEB_WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+INFERENCE_TIMEOUT = 30
+
+# Recognition responses cached for resent frames, "content" keys on the exact
+# pixels, "perceptual" on their perceptual hash, None disables the cache
+RECOGNITION_CACHE = "content"
+RECOGNITION_CACHE_TTL = 30
@@ -16,8 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from api.views import ReadyView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('health/ready', ReadyView.as_view(), name='ready'),
     path('v1/api/', include('api.urls')),
     path('v1/users/', include('user.urls'))
 ]
@@ -1,6 +1,44 @@
+import logging
+import os
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
+
+logger = logging.getLogger(__name__)
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+    warmed_up = threading.Event()
+    warm_up_pid = None
+
+    def ready(self):
+        if not settings.PRELOAD_MODELS:
+            self.warmed_up.set()
+            return
+        # Started by the first request, usually the readiness probe, so the
+        # models load in the process serving requests and never in a parent
+        # that preloads the app and forks, like gunicorn --preload, or in
+        # commands like recognition_worker that serve none
+        request_started.connect(self.start_warm_up, dispatch_uid="api-warm-up")
+
+    def start_warm_up(self, **kwargs) -> None:
+        if self.warm_up_pid == os.getpid():
+            return
+        self.warm_up_pid = os.getpid()
+        threading.Thread(target=self.warm_up, daemon=True).start()
+
+    def warm_up(self) -> None:
+        from .gallery import EmbeddingIndex
+        from .inference import InferencePool
+
+        try:
+            InferencePool.get().warm_up()
+            EmbeddingIndex.get()
+        except Exception:
+            logger.exception("Model warm up failed")
+            return
+        self.warmed_up.set()
@@ -0,0 +1,169 @@
+import cv2
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction
+
+from .gallery import EMBEDDING_SIZE, INDEX_BACKENDS, GalleryStore
+from .model import Attendance, Students
+from .embedders import StubEmbedder
+from .pipeline import Face, FacePipeline
+from .utils import decode_image, response_payload
+
+"""
+Recognition benchmark
+
+Times every stage of a recognition request, decode, detection, embedding,
+gallery search, attendance ORM work and response rendering, against
+synthetic galleries. The fake pipeline embeds its faces with StubEmbedder so
+runs are deterministic and need no model weights, database writes are
+rolled back
+"""
+
+STAGES = ("decode", "detect", "embed", "search", "orm", "response")
+
+
+class FakePipeline(FacePipeline):
+    """
+    Deterministic FacePipeline: the centre square of the image is the face
+    and StubEmbedder embeds it, so the embed stage still preprocesses and
+    batches the crops the way recognition does
+    """
+
+    stub = StubEmbedder()
+
+    @classmethod
+    def embedder(cls):
+        return cls.stub
+
+    @staticmethod
+    def detect(img: np.ndarray, max_side: int = None) -> list:
+        size = min(img.shape[:2]) // 2
+        top = (img.shape[0] - size) // 2
+        left = (img.shape[1] - size) // 2
+        crop = img[top : top + size, left : left + size]
+        return [Face(crop, [left, top, size, size])]
+
+
+def summary(samples: list) -> dict:
+    """
+    Latency percentiles in milliseconds and throughput per second
+    """
+    samples = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {
+        "samples": len(samples),
+        "p50_ms": round(float(p50), 4),
+        "p95_ms": round(float(p95), 4),
+        "p99_ms": round(float(p99), 4),
+        "throughput_per_s": round(float(1000 / samples.mean()), 2),
+    }
+
+
+def frames(count: int, width: int = 640, height: int = 480, seed: int = 0) -> list:
+    """
+    JPEG encoded synthetic frames
+    """
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    encoded = []
+    for _ in range(count):
+        img = gradient + rng.normal(0, 20, (height, width, 3))
+        _, data = cv2.imencode(".jpg", np.clip(img, 0, 255).astype(np.uint8))
+        encoded.append(data.tobytes())
+    return encoded
+
+
+def synthetic_gallery(ref_root: str, rows: int, students: int, seed: int = 0):
+    """
+    Writes a gallery of clustered unit embeddings, several images per student
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((students, EMBEDDING_SIZE)).astype(np.float32)
+    labels = np.arange(rows) % students
+    embeddings = centres[labels] + 0.3 * rng.standard_normal(
+        (rows, EMBEDDING_SIZE)
+    ).astype(np.float32)
+    identities = [
+        os.path.join(ref_root, f"Student {label}", f"{row}.jpg")
+        for row, label in enumerate(labels)
+    ]
+    GalleryStore(ref_root).write(identities, embeddings, [None] * rows)
+    return embeddings
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def run(size: int, requests: int, pipeline=FakePipeline, students: int = None):
+    """
+    Benchmarks requests recognitions against a gallery of size embeddings
+    """
+    from .views import RecognitionView
+
+    students = students or max(1, size // 10)
+    ref_root = tempfile.mkdtemp()
+    try:
+        embeddings = synthetic_gallery(ref_root, size, students)
+        started = time.perf_counter()
+        index = INDEX_BACKENDS[settings.GALLERY_INDEX].load(GalleryStore(ref_root))
+        load_s = time.perf_counter() - started
+        timings = {stage: [] for stage in STAGES}
+        rng = np.random.default_rng(1)
+        queries = embeddings[rng.integers(0, size, requests)]
+        view = RecognitionView()
+        with transaction.atomic():
+            enrolled = Students.objects.bulk_create(
+                [
+                    Students(
+                        first_name=f"Student{i}",
+                        last_name="Benchmark",
+                        email=f"student{i}@benchmark.local",
+                        year=1,
+                        field_of_study="Benchmark",
+                        verified=True,
+                    )
+                    for i in range(min(requests, 1000))
+                ]
+            )
+            Attendance.objects.bulk_create(
+                [
+                    Attendance(student=student, subject="Benchmark")
+                    for student in enrolled
+                ]
+            )
+            for i, data in enumerate(frames(requests)):
+                img, elapsed = timed(decode_image, data)
+                timings["decode"].append(elapsed)
+                faces, elapsed = timed(pipeline.detect, img)
+                timings["detect"].append(elapsed)
+                faces, elapsed = timed(pipeline.embed, faces[:1])
+                timings["embed"].append(elapsed)
+                matches, elapsed = timed(index.search, queries[i])
+                timings["search"].append(elapsed)
+                student, elapsed = timed(
+                    view.mark_attendance, enrolled[i % len(enrolled)].id
+                )
+                timings["orm"].append(elapsed)
+                _, elapsed = timed(
+                    lambda: response_payload(view.respond(student, matches))
+                )
+                timings["response"].append(elapsed)
+            transaction.set_rollback(True)
+    finally:
+        shutil.rmtree(ref_root)
+    return {
+        "gallery": size,
+        "students": students,
+        "index": settings.GALLERY_INDEX,
+        "index_load_ms": round(load_s * 1000, 4),
+        "stages": {stage: summary(timings[stage]) for stage in STAGES},
+        "total": summary(np.sum([timings[stage] for stage in STAGES], axis=0)),
+    }
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import zlib
+import numpy as np
+
+from django.conf import settings
+
+"""
+Embedders
+
+Backends turning a batch of preprocessed face crops into embeddings, the
+one used is chosen with EMBEDDER_BACKEND: DeepFaceEmbedder runs the
+DeepFace ArcFace model on TensorFlow, ONNXEmbedder runs an ONNX export on
+ONNX Runtime's CPU provider and StubEmbedder derives
+deterministic embeddings from the pixels for tests and benchmarks
+"""
+
+
+class Embedder(object):
+    """
+    name keys cached gallery embeddings, backends sharing weights share it
+    """
+
+    name = None
+    input_shape = (112, 112)
+
+    def embed(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Embeddings of a (faces, height, width, 3) float32 batch scaled to [0, 1]
+        """
+        raise NotImplementedError
+
+
+class DeepFaceEmbedder(Embedder):
+    name = "ArcFace"
+
+    def __init__(self):
+        from deepface import DeepFace
+        from deepface.commons import functions
+
+        self.model = DeepFace.build_model(self.name)
+        self.input_shape = tuple(functions.find_input_shape(self.model)[::-1])
+
+    def embed(self, batch: np.ndarray) -> np.ndarray:
+        return self.model.predict(batch, verbose=0)
+
+
+class ModelName(object):
+    """
+    Name of an ONNX embedder, the digest of its model file and preprocessing
+    so a gallery embedded by other weights or inputs is never searched
+    """
+
+    digests = {}
+
+    def __get__(self, instance, owner) -> str:
+        path = settings.EMBEDDER_ONNX_MODEL if instance is None else instance.path
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key not in self.digests:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            self.digests[key] = digest.hexdigest()[:16]
+        return "onnx-{}-{}-{}-{}".format(
+            self.digests[key],
+            "rgb" if settings.EMBEDDER_ONNX_RGB else "bgr",
+            settings.EMBEDDER_ONNX_MEAN,
+            settings.EMBEDDER_ONNX_STD,
+        )
+
+
+class ONNXEmbedder(Embedder):
+    """
+    Runs the model at EMBEDDER_ONNX_MODEL on pixels in the channel order of
+    EMBEDDER_ONNX_RGB normalized as (x - EMBEDDER_ONNX_MEAN) / EMBEDDER_ONNX_STD.
+    Channels first models are fed transposed batches
+    """
+
+    name = ModelName()
+
+    def __init__(self, path: str = None):
+        import onnxruntime
+
+        self.path = settings.EMBEDDER_ONNX_MODEL if path is None else path
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = settings.INFERENCE_INTRA_OP_THREADS
+        options.inter_op_num_threads = settings.INFERENCE_INTER_OP_THREADS
+        self.session = onnxruntime.InferenceSession(
+            self.path,
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.channels_first = model_input.shape[1] == 3
+        shape = (
+            model_input.shape[2:4] if self.channels_first else model_input.shape[1:3]
+        )
+        if all(isinstance(size, int) for size in shape):
+            self.input_shape = tuple(shape)
+
+    def embed(self, batch: np.ndarray) -> np.ndarray:
+        batch = (batch * 255 - settings.EMBEDDER_ONNX_MEAN) / settings.EMBEDDER_ONNX_STD
+        if settings.EMBEDDER_ONNX_RGB:
+            batch = batch[..., ::-1]
+        if self.channels_first:
+            batch = batch.transpose(0, 3, 1, 2)
+        return self.session.run(
+            None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)}
+        )[0]
+
+
+class StubEmbedder(Embedder):
+    name = "stub"
+    size = 512
+
+    def embed(self, batch: np.ndarray) -> np.ndarray:
+        return np.stack(
+            [
+                np.random.default_rng(zlib.crc32(np.ascontiguousarray(face).data))
+                .standard_normal(self.size)
+                .astype(np.float32)
+                for face in batch
+            ]
+        )
@@ -0,0 +1,1300 @@
+import fcntl
+import logging
+import os
+import hashlib
+import json
+import pickle
+import tempfile
+import threading
+import numpy as np
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Value
+from django.db.models.functions import Concat
+
+from .inference import InferencePool
+from .pipeline import embedder_backend, read_image
+
+logger = logging.getLogger(__name__)
+
+"""
+Embedding index
+
+Keeps the ArcFace gallery resident in memory as one float32 matrix so
+recognition is a single matrix-vector product instead of a pickle reload
+"""
+
+GALLERY_FILE = "embeddings_arcface.json"
+GALLERY_VERSION = 4
+LEGACY_REPRESENTATIONS_FILE = "representations_arcface.pkl"
+EMBEDDING_SIZE = 512
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+GALLERY_VERSION_KEY = "gallery-version"
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def identity_name(identity: str) -> str:
+    return os.path.split(os.path.dirname(identity))[-1]
+
+
+def student_ids(identities: list) -> list:
+    """
+    Primary key of the student every image belongs to, matched on the full
+    folder name so names containing spaces resolve too, None for folders
+    without a student
+    """
+    from .model import Students
+
+    names = {identity_name(identity) for identity in identities}
+    students = dict(
+        Students.objects.annotate(
+            full_name=Concat("first_name", Value(" "), "last_name")
+        )
+        .filter(full_name__in=names)
+        .values_list("full_name", "id")
+    )
+    return [students.get(identity_name(identity)) for identity in identities]
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    """
+    Writes path through a uniquely named temporary file next to it that
+    replaces it once complete, so concurrent writers never share a file
+    """
+    fd, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingCache(object):
+    """
+    Embeddings of gallery files keyed by content hash and model name, kept
+    across rebuilds so only new or modified images are embedded again. Files
+    without a face are remembered too
+    """
+
+    def __init__(self, ref_root: str, model: str = "ArcFace"):
+        self.model = model
+        self.path = os.path.join(ref_root, f"embedding_cache_{model.lower()}.npz")
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with np.load(self.path) as cached:
+            if str(cached["model"]) != self.model:
+                return {}
+            return {
+                digest: embedding if found else None
+                for digest, embedding, found in zip(
+                    cached["digests"], cached["embeddings"], cached["found"]
+                )
+            }
+
+    def save(self, entries: dict) -> None:
+        digests = list(entries)
+        with atomic_write(self.path, "wb") as f:
+            np.savez(
+                f,
+                model=self.model,
+                digests=np.array(digests, dtype="U64"),
+                embeddings=np.array(
+                    [
+                        np.zeros(EMBEDDING_SIZE) if entries[d] is None else entries[d]
+                        for d in digests
+                    ],
+                    dtype=np.float32,
+                ).reshape(-1, EMBEDDING_SIZE),
+                found=np.array([entries[d] is not None for d in digests], dtype=bool),
+            )
+
+
+def build_representations(ref_root: str) -> int:
+    """
+    Rebuilds the gallery, returns how many images actually had to be embedded
+    """
+    embedding_cache = EmbeddingCache(ref_root, embedder_backend().name)
+    cached = embedding_cache.load()
+    entries = {}
+    identities = []
+    embeddings = []
+    embedded = 0
+    for name in sorted(os.listdir(ref_root)):
+        folder = os.path.join(ref_root, name)
+        if not os.path.isdir(folder):
+            continue
+        for image in sorted(os.listdir(folder)):
+            if not image.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            identity = os.path.join(folder, image)
+            digest = file_digest(identity)
+            if digest not in cached:
+                faces = InferencePool.get().process(read_image(identity))
+                cached[digest] = faces[0].embedding if faces else None
+                embedded += 1
+            entries[digest] = cached[digest]
+            if cached[digest] is not None:
+                identities.append(identity)
+                embeddings.append(cached[digest])
+    embedding_cache.save(entries)
+    GalleryStore(ref_root).write(identities, embeddings)
+    return embedded
+
+
+def gallery_version() -> int:
+    return cache.get_or_set(GALLERY_VERSION_KEY, 0, timeout=None)
+
+
+def bump_gallery_version() -> None:
+    try:
+        cache.incr(GALLERY_VERSION_KEY)
+    except ValueError:
+        cache.set(GALLERY_VERSION_KEY, 1, timeout=None)
+
+
+"""
+Gallery store
+
+Pickle free on-disk gallery: a float32 .npy matrix opened with mmap so every
+worker shares one page cache copy. Every matrix generation has row files
+next to it, an int32 .npy of the student primary key and folder number of
+every row, the image paths appended to a paths file with their offsets in
+an int64 .npy and the folder names appended to a names file. The JSON
+sidecar only holds the row count and the size of the names file, so an
+append writes one row of every file and a sidecar of constant size, and
+loading maps the files instead of parsing every row. Deleted rows are zeroed
+and get folder -1, a new generation is only written when the matrix is full
+or more than GALLERY_COMPACT_RATIO of its rows are deleted. Writers hold an
+exclusive lock on GALLERY_LOCK_FILE, readers never lock
+"""
+
+GALLERY_LOCK_FILE = ".gallery.lock"
+GALLERY_COMPACT_RATIO = 0.25
+GALLERY_ROW_FILES = {
+    "rows": "rows_arcface.{}.npy",
+    "offsets": "offsets_arcface.{}.npy",
+    "paths": "paths_arcface.{}.txt",
+    "names": "names_arcface.{}.txt",
+}
+_locks = threading.local()
+
+
+@contextmanager
+def gallery_lock(ref_root: str):
+    """
+    Exclusive flock serializing gallery writes across processes and threads,
+    reentrant within a thread
+    """
+    held = _locks.__dict__.setdefault("roots", set())
+    root = os.path.abspath(ref_root)
+    if root in held:
+        yield
+        return
+    with open(os.path.join(root, GALLERY_LOCK_FILE), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        held.add(root)
+        try:
+            yield
+        finally:
+            held.discard(root)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class GalleryRows(object):
+    """
+    Student, folder and path of every gallery row. keys is an (n, 2) int32
+    array of student primary key and folder number, -1 for a row without a
+    student and as the folder of a deleted row. paths is a list, or the bytes
+    of a paths file with the offsets of every row
+    """
+
+    def __init__(self, keys: np.ndarray, names: list, paths, offsets=None):
+        self.keys = keys
+        self.names = names
+        self.numbers = {name: i for i, name in enumerate(names)}
+        self.paths = paths
+        self.offsets = offsets
+
+    @classmethod
+    def from_identities(cls, identities: list, students: list = None):
+        names = sorted({identity_name(i) for i in identities if i is not None})
+        numbers = {name: i for i, name in enumerate(names)}
+        students = [None] * len(identities) if students is None else students
+        keys = np.full((len(identities), 2), -1, dtype=np.int32)
+        for row, (identity, student) in enumerate(zip(identities, students)):
+            if identity is not None:
+                keys[row] = (
+                    -1 if student is None else student,
+                    numbers[identity_name(identity)],
+                )
+        return cls(keys, names, list(identities))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __getitem__(self, row: int):
+        if self.offsets is None:
+            return self.paths[row]
+        if self.keys[row, 1] < 0:
+            return None
+        return self.paths[self.offsets[row] : self.offsets[row + 1]].tobytes().decode()
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def deleted(self):
+        """
+        Mask of the deleted rows, None when there are none
+        """
+        deleted = self.keys[:, 1] < 0
+        return deleted if deleted.any() else None
+
+    def rows(self, name: str) -> list:
+        """
+        Rows of the student folder
+        """
+        if name not in self.numbers:
+            return []
+        return np.flatnonzero(self.keys[:, 1] == self.numbers[name]).tolist()
+
+    def students(self, rows) -> list:
+        return [None if student < 0 else int(student) for student in self.keys[rows, 0]]
+
+    def student(self, identity: str):
+        """
+        Primary key of the image's student, None when it has none
+        """
+        for row in self.rows(identity_name(identity)):
+            if self[row] == identity:
+                return self.students([row])[0]
+        return None
+
+
+class GalleryStore(object):
+    def __init__(self, ref_root: str = None):
+        self.ref_root = settings.REF_ROOT if ref_root is None else ref_root
+        self.path = os.path.join(self.ref_root, GALLERY_FILE)
+
+    def ensure(self) -> None:
+        if os.path.exists(self.path):
+            return
+        with gallery_lock(self.ref_root):
+            if os.path.exists(self.path):
+                return
+            legacy = os.path.join(self.ref_root, LEGACY_REPRESENTATIONS_FILE)
+            if os.path.exists(legacy):
+                with open(legacy, "rb") as f:
+                    representations = pickle.load(f)
+                self.write(
+                    [row[0] for row in representations],
+                    [row[1] for row in representations],
+                )
+            else:
+                build_representations(self.ref_root)
+
+    def sidecar(self) -> dict:
+        """
+        The current sidecar, the gallery is rebuilt from its images when it
+        was embedded by another backend than EMBEDDER_BACKEND
+        """
+        self.ensure()
+        sidecar = self._read_sidecar()
+        model = embedder_backend().name
+        if sidecar["model"] != model:
+            with gallery_lock(self.ref_root):
+                sidecar = self._read_sidecar()
+                if sidecar["model"] != model:
+                    logger.warning(
+                        "Gallery %s was embedded with %s, rebuilding it with %s",
+                        self.ref_root,
+                        sidecar["model"],
+                        model,
+                    )
+                    build_representations(self.ref_root)
+                    sidecar = self._read_sidecar()
+        return sidecar
+
+    def _read_sidecar(self) -> dict:
+        with open(self.path) as f:
+            sidecar = json.load(f)
+        if sidecar["version"] < GALLERY_VERSION:
+            with gallery_lock(self.ref_root):
+                with open(self.path) as f:
+                    sidecar = json.load(f)
+                if sidecar["version"] < GALLERY_VERSION:
+                    self.upgrade(sidecar)
+                    return self._read_sidecar()
+        if sidecar["version"] != GALLERY_VERSION:
+            raise ValueError(f"Unsupported gallery version {sidecar['version']}")
+        return sidecar
+
+    def upgrade(self, sidecar: dict) -> None:
+        """
+        Writes the rows a version 1 to 3 sidecar lists as a new generation,
+        version 1 rows hold the folder name instead of the student
+        """
+        identities = [row[1] for row in sidecar["rows"]]
+        if sidecar["version"] == 1:
+            students = student_ids(identities)
+        else:
+            students = [row[0] for row in sidecar["rows"]]
+        live = [i for i, identity in enumerate(identities) if identity is not None]
+        self.write(
+            [identities[i] for i in live],
+            np.asarray(self.matrix(sidecar)[live]),
+            [students[i] for i in live],
+        )
+
+    def matrix(self, sidecar: dict, mode: str = "r") -> np.ndarray:
+        return np.load(os.path.join(self.ref_root, sidecar["matrix"]), mmap_mode=mode)
+
+    def file(self, sidecar: dict, kind: str) -> str:
+        return os.path.join(
+            self.ref_root, GALLERY_ROW_FILES[kind].format(sidecar["generation"])
+        )
+
+    def rows(self, sidecar: dict) -> GalleryRows:
+        count = sidecar["count"]
+        offsets = np.load(self.file(sidecar, "offsets"), mmap_mode="r")[: count + 1]
+        with open(self.file(sidecar, "names"), "rb") as f:
+            names = f.read(sidecar["names_size"]).decode().splitlines()
+        size = int(offsets[count])
+        if size:
+            paths = np.memmap(self.file(sidecar, "paths"), np.uint8, "r", shape=size)
+        else:
+            paths = np.zeros(0, dtype=np.uint8)
+        return GalleryRows(
+            np.load(self.file(sidecar, "rows"), mmap_mode="r")[:count],
+            names,
+            paths,
+            offsets,
+        )
+
+    def load(self) -> tuple:
+        """
+        Identities and embeddings of every row, deleted rows have a None
+        identity and a zero embedding
+        """
+        sidecar = self.sidecar()
+        return list(self.rows(sidecar)), self.matrix(sidecar)[: sidecar["count"]]
+
+    def _write_sidecar(self, sidecar: dict) -> None:
+        sidecar["revision"] = sidecar.get("revision", 0) + 1
+        with atomic_write(self.path) as f:
+            f.write(json.dumps(sidecar, separators=(",", ":")))
+        bump_gallery_version()
+
+    def append(self, sidecar: dict, kind: str, position: int, data: bytes) -> None:
+        """
+        Writes data at the committed end of a row file, dropping whatever an
+        interrupted writer left after it
+        """
+        with open(self.file(sidecar, kind), "r+b") as f:
+            f.seek(position)
+            f.write(data)
+            f.truncate()
+
+    def write(self, identities: list, embeddings, students: list = None) -> None:
+        students = student_ids(identities) if students is None else students
+        with gallery_lock(self.ref_root):
+            previous = None
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    previous = json.load(f)
+            generation = previous["generation"] + 1 if previous else 1
+            capacity = max(2 * len(identities), 64)
+            sidecar = {
+                "version": GALLERY_VERSION,
+                "model": embedder_backend().name,
+                "generation": generation,
+                "matrix": f"embeddings_arcface.{generation}.npy",
+                "count": len(identities),
+                "names_size": 0,
+                "deleted": 0,
+                "revision": previous.get("revision", 0) if previous else 0,
+            }
+            matrix = np.lib.format.open_memmap(
+                os.path.join(self.ref_root, sidecar["matrix"]),
+                mode="w+",
+                dtype=np.float32,
+                shape=(capacity, EMBEDDING_SIZE),
+            )
+            if len(identities):
+                matrix[: len(identities)] = normalize(embeddings)
+            matrix.flush()
+            del matrix
+            rows = GalleryRows.from_identities(identities, students)
+            keys = np.lib.format.open_memmap(
+                self.file(sidecar, "rows"),
+                mode="w+",
+                dtype=np.int32,
+                shape=(capacity, 2),
+            )
+            keys[:] = -1
+            keys[: len(rows)] = rows.keys
+            keys.flush()
+            del keys
+            paths = [identity.encode() for identity in identities]
+            offsets = np.lib.format.open_memmap(
+                self.file(sidecar, "offsets"),
+                mode="w+",
+                dtype=np.int64,
+                shape=(capacity + 1,),
+            )
+            offsets[1 : len(paths) + 1] = np.cumsum([len(path) for path in paths])
+            offsets.flush()
+            del offsets
+            with open(self.file(sidecar, "paths"), "wb") as f:
+                f.write(b"".join(paths))
+            names = "".join(f"{name}\n" for name in rows.names).encode()
+            with open(self.file(sidecar, "names"), "wb") as f:
+                f.write(names)
+            sidecar["names_size"] = len(names)
+            self._write_sidecar(sidecar)
+            if previous:
+                stale = [previous["matrix"]] + [
+                    name.format(previous["generation"])
+                    for name in GALLERY_ROW_FILES.values()
+                ]
+                for name in stale:
+                    try:
+                        os.remove(os.path.join(self.ref_root, name))
+                    except OSError:
+                        pass
+
+    def add(self, identity: str, embedding, student: int = None) -> dict:
+        """
+        Appends the image and returns the sidecar written
+        """
+        if student is None:
+            student = student_ids([identity])[0]
+        with gallery_lock(self.ref_root):
+            sidecar = self.sidecar()
+            row = sidecar["count"]
+            matrix = self.matrix(sidecar, mode="r+")
+            if row >= len(matrix):
+                rows = self.rows(sidecar)
+                live = np.flatnonzero(rows.keys[:, 1] >= 0)
+                embeddings = np.vstack([matrix[live], np.asarray(embedding)[None]])
+                del matrix
+                self.write(
+                    [rows[i] for i in live] + [identity],
+                    embeddings,
+                    rows.students(live) + [student],
+                )
+                return self._read_sidecar()
+            name = identity_name(identity)
+            numbers = self.rows(sidecar).numbers
+            folder = numbers.get(name)
+            if folder is None:
+                folder = len(numbers)
+                data = f"{name}\n".encode()
+                self.append(sidecar, "names", sidecar["names_size"], data)
+                sidecar["names_size"] += len(data)
+            offsets = np.load(self.file(sidecar, "offsets"), mmap_mode="r+")
+            path = identity.encode()
+            self.append(sidecar, "paths", int(offsets[row]), path)
+            offsets[row + 1] = offsets[row] + len(path)
+            offsets.flush()
+            del offsets
+            keys = np.load(self.file(sidecar, "rows"), mmap_mode="r+")
+            keys[row] = (-1 if student is None else student, folder)
+            keys.flush()
+            del keys
+            matrix[row] = normalize(embedding)
+            PrototypeStore(self.ref_root).update(sidecar, [(name, matrix[row], 1)])
+            CodeStore(self.ref_root).add(sidecar, row, matrix[row])
+            matrix.flush()
+            del matrix
+            sidecar["count"] += 1
+            self._write_sidecar(sidecar)
+            return sidecar
+
+    def update(self, identity: str, embedding) -> None:
+        with gallery_lock(self.ref_root):
+            student = self.rows(self.sidecar()).student(identity)
+            self.delete(identity)
+            self.add(identity, embedding, student)
+
+    def delete(self, *identities: str) -> None:
+        with gallery_lock(self.ref_root):
+            sidecar = self.sidecar()
+            rows = self.rows(sidecar)
+            self.remove(
+                sidecar,
+                [
+                    row
+                    for name in {identity_name(identity) for identity in identities}
+                    for row in rows.rows(name)
+                    if rows[row] in identities
+                ],
+            )
+
+    def remove(self, sidecar: dict, rows: list) -> None:
+        """
+        Deletes rows of a sidecar read under the gallery lock in place,
+        compacting the gallery once too many rows are deleted
+        """
+        if not rows:
+            return
+        gallery = self.rows(sidecar)
+        matrix = self.matrix(sidecar, mode="r+")
+        if sidecar["deleted"] + len(rows) > GALLERY_COMPACT_RATIO * sidecar["count"]:
+            live = np.setdiff1d(np.flatnonzero(gallery.keys[:, 1] >= 0), rows)
+            self.write(
+                [gallery[i] for i in live],
+                np.asarray(matrix[live]),
+                gallery.students(live),
+            )
+            return
+        names = [gallery.names[gallery.keys[row, 1]] for row in rows]
+        PrototypeStore(self.ref_root).update(
+            sidecar, [(n, matrix[row], -1) for n, row in zip(names, rows)]
+        )
+        CodeStore(self.ref_root).delete(sidecar, rows)
+        matrix[sorted(rows)] = 0
+        matrix.flush()
+        del matrix
+        keys = np.load(self.file(sidecar, "rows"), mmap_mode="r+")
+        keys[sorted(rows)] = -1
+        keys.flush()
+        del keys
+        sidecar["deleted"] += len(rows)
+        self._write_sidecar(sidecar)
+
+
+"""
+Gallery policy
+
+Bounds every student folder to GALLERY_MAX_IMAGES embeddings. A recognized
+image is only admitted when it is at least GALLERY_MIN_DIVERSITY cosine
+distance away from the student's stored images, and when a folder is over
+the limit the images that are matched least often and sit closest to
+another image of the student are evicted first. Students are looked up
+through the folder column of the row keys, so neither step reads the matrix
+"""
+
+GALLERY_HITS_KEY = "gallery-hits"
+
+
+class GalleryPolicy(object):
+    def __init__(self, store: GalleryStore = None, index=None):
+        self.store = GalleryStore() if store is None else store
+        self.index = index
+        self.max_images = settings.GALLERY_MAX_IMAGES
+        self.min_diversity = settings.GALLERY_MIN_DIVERSITY
+
+    @staticmethod
+    def hit_key(identity: str) -> str:
+        return f"{GALLERY_HITS_KEY}:{hashlib.sha1(identity.encode()).hexdigest()}"
+
+    def hit(self, identity: str) -> None:
+        key = self.hit_key(identity)
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+    def hits(self, identities: list) -> np.ndarray:
+        counts = cache.get_many([self.hit_key(i) for i in identities])
+        return np.array([counts.get(self.hit_key(i), 0) for i in identities])
+
+    def student(self, name: str) -> tuple:
+        """
+        Identities and embeddings of the student's images in the resident
+        index, the store's is loaded when no index was given
+        """
+        index = EmbeddingIndex.load(self.store) if self.index is None else self.index
+        rows = index.rows(name)
+        return [index.identities[i] for i in rows], np.asarray(index.matrix[rows])
+
+    def admit(self, name: str, embedding) -> bool:
+        """
+        Whether the embedding adds diversity to the student's images
+        """
+        _, matrix = self.student(name)
+        if len(matrix) == 0:
+            return True
+        return float(np.min(1 - matrix @ normalize(embedding))) >= self.min_diversity
+
+    def enroll(self, identity: str, embedding, student: int = None) -> list:
+        """
+        Adds the image to the gallery, evicts images of its student over the
+        limit and returns their paths
+        """
+        with gallery_lock(self.store.ref_root):
+            sidecar = self.store.add(identity, embedding, student)
+            return self.evict(identity_name(identity), sidecar)
+
+    def evict(self, name: str, sidecar: dict = None) -> list:
+        """
+        Removes the least useful images of the student until the folder is
+        within the limit and returns their paths
+        """
+        with gallery_lock(self.store.ref_root):
+            sidecar = self.store.sidecar() if sidecar is None else sidecar
+            gallery = self.store.rows(sidecar)
+            rows = gallery.rows(name)
+            excess = len(rows) - self.max_images
+            if excess <= 0:
+                return []
+            identities = [gallery[row] for row in rows]
+            matrix = np.asarray(self.store.matrix(sidecar)[rows])
+            distances = 1 - matrix @ matrix.T
+            np.fill_diagonal(distances, np.inf)
+            hits = self.hits(identities)
+            kept = np.ones(len(identities), dtype=bool)
+            for _ in range(excess):
+                redundancy = np.maximum(distances[:, kept].min(axis=1), 0)
+                score = (hits + 1) * redundancy
+                score[~kept] = np.inf
+                victim = np.lexsort((hits, score))[0]
+                kept[victim] = False
+            evicted = [identities[i] for i in np.flatnonzero(~kept)]
+            for identity in evicted:
+                try:
+                    os.remove(identity)
+                except OSError:
+                    pass
+            cache.delete_many([self.hit_key(i) for i in evicted])
+            self.store.remove(sidecar, [rows[i] for i in np.flatnonzero(~kept)])
+        return evicted
+
+
+class EmbeddingIndex(object):
+    __instance = None
+    __stat = None
+
+    def __init__(self, identities=(), embeddings=None, normalized=False):
+        if not isinstance(identities, GalleryRows):
+            identities = GalleryRows.from_identities(list(identities))
+        self.identities = identities
+        self.deleted = identities.deleted()
+        if embeddings is None or len(self.identities) == 0:
+            self.matrix = np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+        elif normalized:
+            self.matrix = embeddings
+        else:
+            self.matrix = normalize(embeddings)
+
+    @classmethod
+    def load(cls, store: GalleryStore):
+        return cls.from_sidecar(store, store.sidecar())
+
+    @classmethod
+    def from_sidecar(cls, store: GalleryStore, sidecar: dict):
+        return cls(
+            identities=store.rows(sidecar),
+            embeddings=store.matrix(sidecar)[: sidecar["count"]],
+            normalized=True,
+        )
+
+    @classmethod
+    def get(cls):
+        store = GalleryStore()
+        store.ensure()
+        stat = os.stat(store.path)
+        stat = (stat.st_ino, stat.st_mtime_ns)
+        if cls.__instance is None or cls.__stat != stat:
+            cls.__instance = INDEX_BACKENDS[settings.GALLERY_INDEX].load(store)
+            cls.__stat = stat
+        return cls.__instance
+
+    @classmethod
+    def reset(cls) -> None:
+        cls.__instance = None
+        cls.__stat = None
+
+    def rows(self, name: str) -> list:
+        """
+        Rows of the student folder
+        """
+        return self.identities.rows(name)
+
+    def student(self, identity: str):
+        return self.identities.student(identity)
+
+    def __len__(self) -> int:
+        return len(self.identities)
+
+    def search(self, embedding, k: int = None, threshold: float = None) -> list:
+        """
+        Returns (identity, cosine distance) pairs under the threshold closest
+        first, limited to the k best when k is given
+        """
+        if len(self) == 0:
+            return []
+        query = normalize(embedding)
+        rows = self.candidates(query)
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return self.select(1 - matrix @ query, rows, k, threshold)
+
+    def search_many(self, embeddings, k: int = None, threshold: float = None) -> list:
+        """
+        search for several queries scored with a single matrix multiply
+        """
+        if len(self) == 0 or len(embeddings) == 0:
+            return [[] for _ in embeddings]
+        distances = 1 - normalize(embeddings) @ self.matrix.T
+        return [self.select(row, None, k, threshold) for row in distances]
+
+    def select(self, distances: np.ndarray, rows, k: int, threshold: float) -> list:
+        threshold = settings.RECOGNITION_THRESHOLD if threshold is None else threshold
+        top = np.flatnonzero(distances <= threshold)
+        if self.deleted is not None:
+            top = top[~self.deleted[top if rows is None else rows[top]]]
+        if k is not None and len(top) > k:
+            top = top[np.argpartition(distances[top], k - 1)[:k]]
+        top = top[np.argsort(distances[top], kind="stable")]
+        ids = top if rows is None else rows[top]
+        return [(self.identities[i], float(d)) for i, d in zip(ids, distances[top])]
+
+    def candidates(self, query: np.ndarray):
+        """
+        Rows worth scoring for the query, None scores the whole gallery
+        """
+        return None
+
+
+class BucketIndex(EmbeddingIndex):
+    """
+    Rows grouped under unit centroids, a query only scores the rows of the
+    probes centroids closest to it
+    """
+
+    centroids = None
+    assignments = None
+    probes = 1
+
+    def bucket(self, centroids: np.ndarray, assignments: np.ndarray) -> None:
+        self.centroids = centroids
+        self.assignments = assignments
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(
+            assignments[self.order], np.arange(len(centroids) + 1)
+        )
+
+    def search_many(self, embeddings, k: int = None, threshold: float = None) -> list:
+        return [self.search(embedding, k, threshold) for embedding in embeddings]
+
+    def candidates(self, query: np.ndarray):
+        probes = min(self.probes, len(self.centroids))
+        if probes == 0:
+            return np.zeros(0, dtype=np.int64)
+        nearest = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+        return np.sort(
+            np.concatenate(
+                [self.order[self.offsets[i] : self.offsets[i + 1]] for i in nearest]
+            )
+        )
+
+
+"""
+Prototype index
+
+Two stage search: one mean embedding per student shortlists the
+GALLERY_SHORTLIST closest students, then only their images are re-ranked.
+The per student sums and counts are persisted next to the gallery and kept
+current by GalleryStore on add and delete, so loading the index does not
+sum the whole gallery again
+"""
+
+PROTOTYPE_FILE = "prototypes_arcface.npz"
+
+
+def prototype_sums(matrix: np.ndarray, rows: GalleryRows) -> tuple:
+    """
+    Folder names with the sum and count of their rows
+    """
+    folders = rows.keys[:, 1]
+    order = np.argsort(folders, kind="stable")
+    bounds = np.searchsorted(folders[order], np.arange(len(rows.names) + 1))
+    sums = np.zeros((len(rows.names), EMBEDDING_SIZE), dtype=np.float32)
+    for i in range(len(rows.names)):
+        sums[i] = matrix[order[bounds[i] : bounds[i + 1]]].sum(axis=0)
+    return list(rows.names), sums, np.diff(bounds)
+
+
+class PrototypeStore(object):
+    """
+    Prototype sums valid for the sidecar revision they were saved with
+    """
+
+    def __init__(self, ref_root: str):
+        self.path = os.path.join(ref_root, PROTOTYPE_FILE)
+
+    def load(self, sidecar: dict):
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as prototypes:
+            if int(prototypes["revision"]) != sidecar["revision"]:
+                return None
+            return (
+                prototypes["names"].tolist(),
+                prototypes["sums"],
+                prototypes["counts"],
+            )
+
+    def save(self, revision: int, names: list, sums, counts) -> None:
+        with atomic_write(self.path, "wb") as f:
+            np.savez(
+                f,
+                revision=revision,
+                names=np.array(names, dtype=str),
+                sums=sums,
+                counts=counts,
+            )
+
+    def update(self, sidecar: dict, changes: list) -> None:
+        """
+        Applies the (name, unit embedding, +1 or -1) changes of the sidecar
+        about to be written, sums saved for another revision are left stale
+        """
+        prototypes = self.load(sidecar)
+        if prototypes is None:
+            return
+        names, sums, counts = prototypes
+        positions = {name: i for i, name in enumerate(names)}
+        added = sorted({name for name, _, _ in changes} - set(positions))
+        if added:
+            positions.update({name: len(names) + i for i, name in enumerate(added)})
+            names = names + added
+            sums = np.vstack([sums, np.zeros((len(added), EMBEDDING_SIZE), sums.dtype)])
+            counts = np.concatenate([counts, np.zeros(len(added), counts.dtype)])
+        for name, embedding, sign in changes:
+            sums[positions[name]] += sign * embedding
+            counts[positions[name]] += sign
+        self.save(sidecar["revision"] + 1, names, sums, counts)
+
+
+class PrototypeIndex(BucketIndex):
+    def __init__(
+        self,
+        identities=(),
+        embeddings=None,
+        normalized=False,
+        shortlist: int = None,
+        prototypes: tuple = None,
+    ):
+        super().__init__(identities, embeddings, normalized)
+        self.probes = settings.GALLERY_SHORTLIST if shortlist is None else shortlist
+        if prototypes is None:
+            prototypes = prototype_sums(self.matrix, self.identities)
+        self.names, self.sums, self.counts = prototypes
+        positions = {name: i for i, name in enumerate(self.names)}
+        # folder -1 of deleted rows picks the trailing -1
+        positions = np.array(
+            [positions.get(name, -1) for name in self.identities.names] + [-1],
+            dtype=np.int32,
+        )
+        assignments = positions[self.identities.keys[:, 1]]
+        centroids = normalize(self.sums)
+        centroids[self.counts == 0] = 0
+        self.bucket(centroids, assignments)
+
+    @classmethod
+    def from_sidecar(cls, store: GalleryStore, sidecar: dict):
+        prototypes = PrototypeStore(store.ref_root)
+        saved = prototypes.load(sidecar)
+        index = cls(
+            identities=store.rows(sidecar),
+            embeddings=store.matrix(sidecar)[: sidecar["count"]],
+            normalized=True,
+            prototypes=saved,
+        )
+        if saved is None:
+            prototypes.save(sidecar["revision"], index.names, index.sums, index.counts)
+        return index
+
+
+"""
+IVF index
+
+Approximate search for large galleries: rows are bucketed under spherical
+k-means centroids and a query only scores the rows of its nearest probes.
+Centroids and assignments are persisted next to the gallery, rows appended
+after training are assigned to their nearest centroid on load until the
+gallery drifts GALLERY_IVF_RETRAIN_RATIO times from its trained size
+"""
+
+IVF_FILE = "ivf_arcface.npz"
+
+
+class IVFIndex(BucketIndex):
+    def __init__(
+        self,
+        identities=(),
+        embeddings=None,
+        normalized=False,
+        centroids=None,
+        assignments=None,
+        lists: int = None,
+        probes: int = None,
+        trained: int = None,
+    ):
+        super().__init__(identities, embeddings, normalized)
+        self.probes = settings.GALLERY_IVF_PROBES if probes is None else probes
+        lists = settings.GALLERY_IVF_LISTS if lists is None else lists
+        if centroids is None:
+            centroids = self.train(self.matrix, lists)
+            trained = len(self)
+            if self.deleted is not None:
+                trained -= int(self.deleted.sum())
+        self.trained = len(self) if trained is None else trained
+        self.centroids = normalize(centroids)
+        if assignments is None or len(assignments) > len(self):
+            assignments = np.zeros(0, dtype=np.int32)
+        self.bucket(
+            self.centroids,
+            np.concatenate(
+                [assignments, self.assign(self.matrix[len(assignments) :])]
+            ).astype(np.int32),
+        )
+
+    @staticmethod
+    def train(matrix: np.ndarray, lists: int, iterations: int = 10, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        lists = max(1, min(lists, len(matrix)))
+        if len(matrix) == 0:
+            return np.zeros((1, EMBEDDING_SIZE), dtype=np.float32)
+        sample = matrix[
+            rng.choice(len(matrix), min(len(matrix), 256 * lists), replace=False)
+        ]
+        sample = np.asarray(sample, dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(lists):
+                members = sample[assignments == i]
+                if len(members):
+                    centroids[i] = members.sum(axis=0)
+            centroids = normalize(centroids)
+        return centroids
+
+    def assign(self, rows: np.ndarray) -> np.ndarray:
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.argmax(rows @ self.centroids.T, axis=1).astype(np.int32)
+
+    @staticmethod
+    def drifted(centroids: np.ndarray, trained: int, rows: int) -> bool:
+        """
+        Whether centroids trained on that many rows no longer fit the gallery,
+        it grew or shrank past GALLERY_IVF_RETRAIN_RATIO of them or their
+        number is not the configured one
+        """
+        ratio = settings.GALLERY_IVF_RETRAIN_RATIO
+        if len(centroids) != max(1, min(settings.GALLERY_IVF_LISTS, rows)):
+            return True
+        return rows > trained * ratio or rows * ratio < trained
+
+    @classmethod
+    def from_sidecar(cls, store: GalleryStore, sidecar: dict):
+        matrix = store.matrix(sidecar)[: sidecar["count"]]
+        path = os.path.join(store.ref_root, IVF_FILE)
+        centroids = assignments = trained = None
+        if os.path.exists(path):
+            with np.load(path) as ivf:
+                centroids = ivf["centroids"]
+                trained = int(ivf["trained"]) if "trained" in ivf else 0
+                if int(ivf["generation"]) == sidecar["generation"]:
+                    assignments = ivf["assignments"]
+            live = sidecar["count"] - sidecar["deleted"]
+            if cls.drifted(centroids, trained, live):
+                logger.info("Retraining IVF centroids for %s rows", live)
+                centroids = assignments = trained = None
+        index = cls(
+            identities=store.rows(sidecar),
+            embeddings=matrix,
+            normalized=True,
+            centroids=centroids,
+            assignments=assignments,
+            trained=trained,
+        )
+        if assignments is None or len(assignments) != len(index):
+            index.save(path, sidecar["generation"])
+        return index
+
+    def save(self, path: str, generation: int) -> None:
+        with atomic_write(path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                assignments=self.assignments,
+                generation=generation,
+                trained=self.trained,
+            )
+
+
+"""
+Quantized index
+
+Scores the whole gallery against int8 codes, a quarter of the float32
+matrix, and re-ranks the candidates with the exact float32 rows.
+Candidates are the rows within GALLERY_QUANTIZATION_MARGIN of the
+threshold on the approximate scores, cut to the GALLERY_RERANK best when k
+is given. The codes of a matrix generation are a .npy file next to it that
+every worker maps, GalleryStore codes appended rows and zeroes deleted ones
+"""
+
+CODES_FILE = "int8_arcface.npz"
+
+
+def int8_scales(matrix: np.ndarray) -> np.ndarray:
+    """
+    Per dimension scales, a code times its scale approximates the embedding
+    """
+    scales = np.zeros(EMBEDDING_SIZE, dtype=np.float32)
+    for start in range(0, len(matrix), 4096):
+        np.maximum(scales, np.abs(matrix[start : start + 4096]).max(axis=0), out=scales)
+    scales[scales == 0] = 1
+    return scales / 127
+
+
+def int8_codes(rows: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(rows / scales), -127, 127).astype(np.int8)
+
+
+class CodeStore(object):
+    """
+    CODES_FILE holds the generation, scales and number of coded rows of the
+    codes file of that matrix generation
+    """
+
+    def __init__(self, ref_root: str):
+        self.ref_root = ref_root
+        self.path = os.path.join(ref_root, CODES_FILE)
+
+    def meta(self, sidecar: dict):
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as meta:
+            if int(meta["generation"]) != sidecar["generation"]:
+                return None
+            return {
+                "codes": str(meta["codes"]),
+                "scales": meta["scales"],
+                "coded": int(meta["coded"]),
+            }
+
+    def save(self, sidecar: dict, meta: dict) -> None:
+        with atomic_write(self.path, "wb") as f:
+            np.savez(f, generation=sidecar["generation"], **meta)
+
+    def codes(self, meta: dict, mode: str = "r") -> np.ndarray:
+        return np.load(os.path.join(self.ref_root, meta["codes"]), mmap_mode=mode)
+
+    def prepare(self, store: GalleryStore, sidecar: dict) -> tuple:
+        """
+        Codes of every row of the sidecar and their scales, the generation
+        is coded under the gallery lock when it has no codes yet
+        """
+        rows = sidecar["count"]
+        meta = self.meta(sidecar)
+        if meta is None or meta["coded"] < rows:
+            with gallery_lock(self.ref_root):
+                meta = self.meta(sidecar)
+                matrix = store.matrix(sidecar)
+                if meta is None:
+                    meta = {
+                        "codes": f"embeddings_int8.{sidecar['generation']}.npy",
+                        "scales": int8_scales(matrix[:rows]),
+                        "coded": 0,
+                    }
+                    fd, temporary = tempfile.mkstemp(dir=self.ref_root, suffix=".tmp")
+                    os.close(fd)
+                    codes = np.lib.format.open_memmap(
+                        temporary, mode="w+", dtype=np.int8, shape=matrix.shape
+                    )
+                    del codes
+                    os.chmod(temporary, 0o644)
+                    os.replace(temporary, os.path.join(self.ref_root, meta["codes"]))
+                    self.remove_stale(meta["codes"])
+                if meta["coded"] < rows:
+                    codes = self.codes(meta, mode="r+")
+                    for start in range(meta["coded"], rows, 4096):
+                        end = min(start + 4096, rows)
+                        codes[start:end] = int8_codes(matrix[start:end], meta["scales"])
+                    codes.flush()
+                    del codes
+                    meta["coded"] = rows
+                    self.save(sidecar, meta)
+        return self.codes(meta)[:rows], meta["scales"]
+
+    def remove_stale(self, current: str) -> None:
+        for name in os.listdir(self.ref_root):
+            if name.startswith("embeddings_int8.") and name != current:
+                try:
+                    os.remove(os.path.join(self.ref_root, name))
+                except OSError:
+                    pass
+
+    def add(self, sidecar: dict, row: int, embedding) -> None:
+        """
+        Codes the row appended to a fully coded generation
+        """
+        meta = self.meta(sidecar)
+        if meta is None or row != meta["coded"]:
+            return
+        codes = self.codes(meta, mode="r+")
+        codes[row] = int8_codes(embedding, meta["scales"])
+        codes.flush()
+        del codes
+        meta["coded"] += 1
+        self.save(sidecar, meta)
+
+    def delete(self, sidecar: dict, rows: list) -> None:
+        meta = self.meta(sidecar)
+        rows = sorted(row for row in rows if meta and row < meta["coded"])
+        if rows:
+            codes = self.codes(meta, mode="r+")
+            codes[rows] = 0
+            codes.flush()
+            del codes
+
+
+class Int8Index(EmbeddingIndex):
+    chunk = 256
+
+    def __init__(
+        self,
+        identities=(),
+        embeddings=None,
+        normalized=False,
+        rerank: int = None,
+        codes: np.ndarray = None,
+        scales: np.ndarray = None,
+    ):
+        super().__init__(identities, embeddings, normalized)
+        self.rerank = settings.GALLERY_RERANK if rerank is None else rerank
+        self.margin = settings.GALLERY_QUANTIZATION_MARGIN
+        if codes is None:
+            scales = int8_scales(self.matrix)
+            codes = np.empty((len(self), EMBEDDING_SIZE), dtype=np.int8)
+            for start in range(0, len(self), 4096):
+                codes[start : start + 4096] = int8_codes(
+                    self.matrix[start : start + 4096], scales
+                )
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_sidecar(cls, store: GalleryStore, sidecar: dict):
+        codes, scales = CodeStore(store.ref_root).prepare(store, sidecar)
+        return cls(
+            identities=store.rows(sidecar),
+            embeddings=store.matrix(sidecar)[: sidecar["count"]],
+            normalized=True,
+            codes=codes,
+            scales=scales,
+        )
+
+    def approximate(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Approximate cosine distances of (queries, dim) unit queries, codes are
+        widened a chunk at a time so no float32 copy of the gallery is made
+        """
+        queries = (queries * self.scales).T
+        distances = np.empty((len(self), queries.shape[1]), dtype=np.float32)
+        block = np.empty((self.chunk, EMBEDDING_SIZE), dtype=np.float32)
+        for start in range(0, len(self), self.chunk):
+            codes = self.codes[start : start + self.chunk]
+            np.copyto(block[: len(codes)], codes, casting="unsafe")
+            np.dot(
+                block[: len(codes)], queries, out=distances[start : start + self.chunk]
+            )
+        return 1 - distances.T
+
+    def shortlist(self, approximate: np.ndarray, k: int, threshold: float):
+        threshold = settings.RECOGNITION_THRESHOLD if threshold is None else threshold
+        rows = np.flatnonzero(approximate <= threshold + self.margin)
+        limit = max(self.rerank, k or 0)
+        if k is not None and len(rows) > limit:
+            rows = rows[np.argpartition(approximate[rows], limit - 1)[:limit]]
+        return np.sort(rows)
+
+    def rerank_rows(self, query: np.ndarray, rows, k: int, threshold: float) -> list:
+        if len(rows) == 0:
+            return []
+        return self.select(1 - self.matrix[rows] @ query, rows, k, threshold)
+
+    def search(self, embedding, k: int = None, threshold: float = None) -> list:
+        if len(self) == 0:
+            return []
+        query = normalize(embedding)
+        rows = self.shortlist(self.approximate(query[None])[0], k, threshold)
+        return self.rerank_rows(query, rows, k, threshold)
+
+    def search_many(self, embeddings, k: int = None, threshold: float = None) -> list:
+        if len(self) == 0 or len(embeddings) == 0:
+            return [[] for _ in embeddings]
+        queries = normalize(embeddings)
+        return [
+            self.rerank_rows(
+                query, self.shortlist(approximate, k, threshold), k, threshold
+            )
+            for query, approximate in zip(queries, self.approximate(queries))
+        ]
+
+
+INDEX_BACKENDS = {
+    "exact": EmbeddingIndex,
+    "ivf": IVFIndex,
+    "prototype": PrototypeIndex,
+    "int8": Int8Index,
+}
+
+
+def recall_at_k(
+    index: EmbeddingIndex, exact: EmbeddingIndex, queries, k: int = 10
+) -> float:
+    """
+    Mean fraction of the exact top k identities the index also returns
+    """
+    found = 0
+    for query in queries:
+        expected = {i for i, _ in exact.search(query, k=k, threshold=2)}
+        returned = {i for i, _ in index.search(query, k=k, threshold=2)}
+        found += len(expected & returned) / max(len(expected), 1)
+    return found / max(len(queries), 1)
+
+
+def distance_delta(index: EmbeddingIndex, exact: EmbeddingIndex, queries) -> float:
+    """
+    Mean absolute difference between the best distance the index and exact
+    search return
+    """
+    deltas = [
+        abs(
+            index.search(query, k=1, threshold=2)[0][1]
+            - exact.search(query, k=1, threshold=2)[0][1]
+        )
+        for query in queries
+    ]
+    return float(np.mean(deltas)) if deltas else 0.0
@@ -0,0 +1,133 @@
+import os
+import multiprocessing
+
+from .pipeline import FacePipeline
+
+"""
+Inference pool
+
+Detection and embedding run in a pool of processes sized to the CPU cores,
+each holding one detector and embedder copy with explicit TensorFlow thread
+settings so concurrent requests scale with cores instead of fighting over
+threads inside the web workers
+"""
+
+
+def set_threads(intra_op: int, inter_op: int) -> None:
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+
+init_error = None
+
+
+def init_worker(intra_op: int, inter_op: int) -> None:
+    """
+    Keeps the worker alive when loading fails, an initializer that raises
+    makes the pool respawn workers forever and leaves callers waiting, so the
+    error is raised from every task instead
+    """
+    global init_error
+    try:
+        set_threads(intra_op, inter_op)
+        FacePipeline.warm_up()
+    except Exception as e:
+        init_error = repr(e)
+
+
+def call(func, *args):
+    if init_error is not None:
+        raise RuntimeError("Inference worker failed to start: " + init_error)
+    return func(*args)
+
+
+def ping(_=None) -> int:
+    return os.getpid()
+
+
+class InferencePool(object):
+    __instance = None
+
+    def __init__(
+        self,
+        processes: int = 0,
+        intra_op: int = 1,
+        inter_op: int = 1,
+        timeout: float = None,
+    ):
+        self.processes = processes
+        self.timeout = timeout
+        self.pool = None
+        if processes:
+            self.pool = multiprocessing.get_context("spawn").Pool(
+                processes, initializer=init_worker, initargs=(intra_op, inter_op)
+            )
+
+    @classmethod
+    def get(cls):
+        if cls.__instance is None:
+            from django.conf import settings
+
+            processes = settings.INFERENCE_PROCESSES
+            if processes is None:
+                processes = max(
+                    1,
+                    (os.cpu_count() or 1)
+                    // settings.INFERENCE_INTRA_OP_THREADS
+                    // settings.INFERENCE_WEB_WORKERS,
+                )
+            cls.__instance = cls(
+                processes,
+                settings.INFERENCE_INTRA_OP_THREADS,
+                settings.INFERENCE_INTER_OP_THREADS,
+                settings.INFERENCE_TIMEOUT,
+            )
+        return cls.__instance
+
+    @classmethod
+    def inline(cls, intra_op: int = None, inter_op: int = None):
+        """
+        Runs inference in this process, for processes that are pool workers
+        themselves like the recognition job workers
+        """
+        if intra_op is not None:
+            set_threads(intra_op, inter_op or 1)
+        cls.__instance = cls(0)
+        return cls.__instance
+
+    @classmethod
+    def reset(cls) -> None:
+        if cls.__instance is not None and cls.__instance.pool is not None:
+            cls.__instance.pool.terminate()
+        cls.__instance = None
+
+    def warm_up(self) -> None:
+        if self.pool is None:
+            FacePipeline.warm_up()
+        else:
+            self.map(ping, range(self.processes))
+
+    def apply(self, func, *args):
+        return self.pool.apply_async(call, (func, *args)).get(self.timeout)
+
+    def map(self, func, items) -> list:
+        return self.pool.starmap_async(call, [(func, item) for item in items]).get(
+            self.timeout
+        )
+
+    def process(self, img, max_side: int = None) -> list:
+        if self.pool is None:
+            return FacePipeline.process(img, max_side)
+        return self.apply(FacePipeline.process, img, max_side)
+
+    def detect(self, images: list) -> list:
+        if self.pool is None:
+            return [FacePipeline.detect(img) for img in images]
+        return self.map(FacePipeline.detect, images)
+
+    def embed(self, faces: list) -> list:
+        if self.pool is None or not faces:
+            return FacePipeline.embed(faces)
+        return self.apply(FacePipeline.embed, faces)
@@ -0,0 +1,148 @@
+import base64
+import json
+import logging
+import queue
+import threading
+
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+"""
+Recognition jobs
+
+Recognition requests queued for a pool of inference workers, the backend is
+chosen with RECOGNITION_QUEUE_BACKEND: RedisQueue in production, LocalQueue
+keeps jobs in process for development and tests
+"""
+
+
+class JobQueue(object):
+    def enqueue(self, payload: dict) -> str:
+        raise NotImplementedError
+
+    def dequeue(self, timeout: float = None):
+        """
+        Next (job id, payload) pair or None when nothing arrived in time
+        """
+        raise NotImplementedError
+
+    def finish(self, job_id: str, result: dict) -> None:
+        raise NotImplementedError
+
+    def result(self, job_id: str):
+        raise NotImplementedError
+
+
+class LocalQueue(JobQueue):
+    def __init__(self, workers: int = None):
+        self.jobs = queue.Queue()
+        self.results = {}
+        workers = settings.RECOGNITION_WORKERS if workers is None else workers
+        for _ in range(workers):
+            threading.Thread(target=work, args=(self,), daemon=True).start()
+
+    def enqueue(self, payload: dict) -> str:
+        job_id = str(uuid4())
+        self.results[job_id] = {"state": "pending"}
+        self.jobs.put((job_id, payload))
+        return job_id
+
+    def dequeue(self, timeout: float = None):
+        try:
+            return self.jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def finish(self, job_id: str, result: dict) -> None:
+        self.results[job_id] = result
+
+    def result(self, job_id: str):
+        return self.results.get(job_id)
+
+
+class RedisQueue(JobQueue):
+    key = "recognition-jobs"
+
+    def __init__(self):
+        from redis import Redis
+
+        self.redis = Redis.from_url(settings.RECOGNITION_QUEUE_LOCATION)
+
+    def enqueue(self, payload: dict) -> str:
+        job_id = str(uuid4())
+        pipeline = self.redis.pipeline()
+        pipeline.set(
+            f"{self.key}:{job_id}",
+            json.dumps({"state": "pending"}),
+            ex=settings.RECOGNITION_JOB_TTL,
+        )
+        pipeline.lpush(self.key, json.dumps([job_id, payload]))
+        pipeline.execute()
+        return job_id
+
+    def dequeue(self, timeout: float = None):
+        item = self.redis.brpop(self.key, timeout=timeout or 0)
+        if item is None:
+            return None
+        return tuple(json.loads(item[1]))
+
+    def finish(self, job_id: str, result: dict) -> None:
+        self.redis.set(
+            f"{self.key}:{job_id}", json.dumps(result), ex=settings.RECOGNITION_JOB_TTL
+        )
+
+    def result(self, job_id: str):
+        result = self.redis.get(f"{self.key}:{job_id}")
+        return None if result is None else json.loads(result)
+
+
+class JobQueueHandler(object):
+    __queue = None
+
+    @classmethod
+    def get(cls) -> JobQueue:
+        if cls.__queue is None:
+            cls.__queue = import_string(settings.RECOGNITION_QUEUE_BACKEND)()
+        return cls.__queue
+
+    @classmethod
+    def reset(cls) -> None:
+        cls.__queue = None
+
+
+def encode_image(upload) -> dict:
+    return {
+        "image": base64.b64encode(upload.read()).decode(),
+        "name": upload.name,
+    }
+
+
+def process(job_queue: JobQueue, job_id: str, payload: dict) -> None:
+    from .utils import decode_image, response_payload
+    from .views import RecognitionView
+
+    try:
+        data = base64.b64decode(payload["image"])
+        response = RecognitionView().run(decode_image(data), data)
+        result = {"state": "done", **response_payload(response)}
+    except Exception:
+        logger.exception("Recognition job %s failed", job_id)
+        result = {
+            "state": "failed",
+            "status": 500,
+            "data": {"error": "Recognition failed"},
+        }
+    job_queue.finish(job_id, result)
+
+
+def work(job_queue: JobQueue, stop: threading.Event = None) -> None:
+    while stop is None or not stop.is_set():
+        job = job_queue.dequeue(timeout=1)
+        if job is not None:
+            process(job_queue, *job)
+            close_old_connections()
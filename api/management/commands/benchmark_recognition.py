@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.benchmark import FakePipeline, run
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the decode, detection, embedding, search, ORM and response stages "
+        "of recognition against synthetic galleries and prints p50/p95/p99 "
+        "latencies and throughput as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[1000, 10000, 100000]
+        )
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument(
+            "--pipeline",
+            choices=["fake", "model"],
+            default="fake",
+            help="fake needs no model weights, model runs the real detector and embedder",
+        )
+        parser.add_argument("--output", default=None)
+
+    def handle(self, *args, **options):
+        pipeline = FakePipeline
+        if options["pipeline"] == "model":
+            from api.pipeline import FacePipeline
+
+            pipeline = FacePipeline
+        report = [run(size, options["requests"], pipeline) for size in options["sizes"]]
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        self.stdout.write(output)
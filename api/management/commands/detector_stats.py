@@ -0,0 +1,17 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.pipeline import DetectorStats
+
+
+class Command(BaseCommand):
+    help = "Prints how often the OpenCV and MTCNN detection stages found a face"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true")
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(DetectorStats.get(), indent=2))
+        if options["reset"]:
+            DetectorStats.reset()
@@ -0,0 +1,23 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Deletes uploads in MEDIA_ROOT older than MEDIA_EXPIRY seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=int, default=settings.MEDIA_EXPIRY)
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(settings.MEDIA_ROOT):
+            return
+        expired = time.time() - options["max_age"]
+        removed = 0
+        for entry in os.scandir(settings.MEDIA_ROOT):
+            if entry.is_file() and entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+                removed += 1
+        self.stdout.write(f"Removed {removed} expired uploads")
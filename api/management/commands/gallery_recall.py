@@ -0,0 +1,100 @@
+import time
+import numpy as np
+
+from django.core.management.base import BaseCommand
+
+from api.gallery import (
+    EmbeddingIndex,
+    Int8Index,
+    IVFIndex,
+    PrototypeIndex,
+    GalleryStore,
+    distance_delta,
+    recall_at_k,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures IVF, prototype and quantized recall@k and latency against "
+        "exact search on the gallery"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--lists", type=int, default=None)
+        parser.add_argument("--probes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+        parser.add_argument("--shortlist", type=int, nargs="+", default=[1, 3, 5, 10])
+        parser.add_argument("--noise", type=float, default=0.3)
+        parser.add_argument("--rerank", type=int, nargs="+", default=[10, 50, 200])
+
+    def handle(self, *args, **options):
+        store = GalleryStore()
+        exact = EmbeddingIndex.load(store)
+        if len(exact) == 0:
+            self.stdout.write("Gallery is empty")
+            return
+        rng = np.random.default_rng(0)
+        rows = rng.choice(
+            len(exact), min(options["queries"], len(exact)), replace=False
+        )
+        queries = exact.matrix[rows] + options["noise"] * rng.standard_normal(
+            (len(rows), exact.matrix.shape[1])
+        ).astype(np.float32) / np.sqrt(exact.matrix.shape[1])
+
+        started = time.perf_counter()
+        for query in queries:
+            exact.search(query, k=options["k"], threshold=2)
+        exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        self.stdout.write(f"exact: {len(exact)} rows, {exact_ms:.3f} ms/query")
+
+        ivf = IVFIndex(
+            exact.identities, exact.matrix, normalized=True, lists=options["lists"]
+        )
+        for probes in options["probes"]:
+            ivf.probes = probes
+            self.report(
+                f"ivf lists={len(ivf.centroids)} probes={probes}",
+                ivf,
+                exact,
+                queries,
+                options["k"],
+            )
+
+        prototype = PrototypeIndex(exact.identities, exact.matrix, normalized=True)
+        for shortlist in options["shortlist"]:
+            prototype.probes = shortlist
+            self.report(
+                f"prototype students={len(prototype.centroids)} shortlist={shortlist}",
+                prototype,
+                exact,
+                queries,
+                options["k"],
+            )
+
+        quantized = Int8Index(exact.identities, exact.matrix, normalized=True)
+        memory = quantized.codes.nbytes / exact.matrix.nbytes
+        for rerank in options["rerank"]:
+            quantized.rerank = rerank
+            self.report(
+                f"int8 rerank={rerank} memory={memory:.2f}x",
+                quantized,
+                exact,
+                queries,
+                options["k"],
+            )
+        self.stdout.write(
+            f"int8: top-1 distance delta="
+            f"{distance_delta(quantized, exact, queries):.6f}"
+        )
+
+    def report(self, label, index, exact, queries, k):
+        started = time.perf_counter()
+        for query in queries:
+            index.search(query, k=k, threshold=2)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        recall = recall_at_k(index, exact, queries, k=k)
+        self.stdout.write(
+            f"{label}: recall@{k}={recall:.4f}, {elapsed_ms:.3f} ms/query"
+        )
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.gallery import GalleryStore, build_representations
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the gallery embeddings, re-embedding only new or modified images"
+
+    def handle(self, *args, **options):
+        embedded = build_representations(settings.REF_ROOT)
+        _, matrix = GalleryStore().load()
+        self.stdout.write(
+            f"Gallery rebuilt with {len(matrix)} images, {embedded} embedded"
+        )
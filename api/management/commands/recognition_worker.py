@@ -0,0 +1,33 @@
+from multiprocessing import Process
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.inference import InferencePool
+from api.jobs import JobQueueHandler, work
+
+
+def serve() -> None:
+    InferencePool.inline(
+        settings.INFERENCE_INTRA_OP_THREADS, settings.INFERENCE_INTER_OP_THREADS
+    )
+    work(JobQueueHandler.get())
+
+
+class Command(BaseCommand):
+    help = "Runs a pool of inference workers draining the recognition job queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.RECOGNITION_WORKERS)
+
+    def handle(self, *args, **options):
+        connections.close_all()
+        processes = [
+            Process(target=serve, daemon=True) for _ in range(options["workers"])
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f"Started {len(processes)} recognition workers")
+        for process in processes:
+            process.join()
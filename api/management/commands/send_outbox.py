@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.outbox import drain, send
+
+
+class Command(BaseCommand):
+    help = "Sends the emails queued in the outbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Send the due emails and exit"
+        )
+        parser.add_argument(
+            "--interval", type=float, default=settings.OUTBOX_POLL_INTERVAL
+        )
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            sent = 0
+            while True:
+                batch = drain()
+                if not batch:
+                    break
+                sent += batch
+            self.stdout.write(f"Sent {sent} emails")
+            return
+        send(interval=options["interval"])
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0009_attendance_recognition"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboxEmail",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("subject", models.CharField(max_length=200)),
+                ("message", models.TextField()),
+                ("from_email", models.CharField(blank=True, max_length=254)),
+                ("recipients", models.JSONField()),
+                ("attempts", models.IntegerField(default=0)),
+                (
+                    "next_attempt",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                ("sent", models.DateTimeField(null=True)),
+                ("error", models.TextField(blank=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["sent", "next_attempt"],
+                        name="api_outboxe_sent_4b4fd2_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0010_outboxemail"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RevokedToken",
+            fields=[
+                (
+                    "signature",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("expires", models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0011_revokedtoken"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="attendance",
+            name="token",
+            field=models.CharField(max_length=60, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name="attendance",
+            index=models.Index(
+                fields=["student", "confirmed", "recognition"],
+                name="api_attenda_student_1be7fc_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="students",
+            index=models.Index(
+                fields=["first_name", "last_name"],
+                name="api_student_first_n_e8c611_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="students",
+            index=models.Index(
+                fields=["field_of_study", "year"], name="api_student_field_o_9ab2be_idx"
+            ),
+        ),
+    ]
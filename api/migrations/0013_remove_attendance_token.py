@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:31
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0012_attendance_indexes"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="attendance",
+            name="token",
+        ),
+    ]
@@ -10,11 +10,38 @@ class Students(models.Model):
     verified = models.BooleanField(null=True, default=False)
     field_of_study = models.CharField(max_length=50)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["first_name", "last_name"]),
+            models.Index(fields=["field_of_study", "year"]),
+        ]
+
 
 class Attendance(models.Model):
     student = models.ForeignKey(Students, on_delete=models.CASCADE)
     subject = models.CharField(max_length=50, null=False)
-    token = models.CharField(max_length=60, null=False)
     confirmed = models.BooleanField(null=True, default=False)
     recognition = models.BooleanField(null=True, default=False)
     attendance_date = models.DateTimeField(default=now)
+
+    class Meta:
+        indexes = [models.Index(fields=["student", "confirmed", "recognition"])]
+
+
+class OutboxEmail(models.Model):
+    subject = models.CharField(max_length=200)
+    message = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True)
+    recipients = models.JSONField()
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=now)
+    sent = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["sent", "next_attempt"])]
+
+
+class RevokedToken(models.Model):
+    signature = models.CharField(max_length=64, primary_key=True)
+    expires = models.DateTimeField(db_index=True)
@@ -0,0 +1,142 @@
+import logging
+import threading
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections, transaction
+from django.utils.timezone import now
+
+from .model import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+"""
+Email outbox
+
+Views only store their emails in the outbox table, a background sender
+drains it in batches of OUTBOX_BATCH_SIZE over one reused mail connection
+and retries failed emails with exponential backoff up to
+OUTBOX_MAX_ATTEMPTS times
+"""
+
+
+def enqueue(subject: str, message: str, recipients: list, from_email: str = None):
+    return OutboxEmail.objects.create(
+        subject=subject,
+        message=message,
+        from_email=from_email or settings.EMAIL_HOST_USER,
+        recipients=list(recipients),
+    )
+
+
+def enqueue_many(emails: list) -> list:
+    """
+    Stores (subject, message, from_email, recipients) tuples with one insert
+    """
+    return OutboxEmail.objects.bulk_create(
+        [
+            OutboxEmail(
+                subject=subject,
+                message=message,
+                from_email=from_email or settings.EMAIL_HOST_USER,
+                recipients=list(recipients),
+            )
+            for subject, message, from_email, recipients in emails
+        ]
+    )
+
+
+def retry_later(email: OutboxEmail, error: Exception) -> None:
+    email.attempts += 1
+    email.error = str(error)
+    email.next_attempt = now() + timedelta(
+        seconds=settings.OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1)
+    )
+
+
+def open_connection(connection, reopen: bool = False):
+    """
+    Opens the mail connection and returns the error when that failed
+    """
+    try:
+        if reopen:
+            connection.close()
+        connection.open()
+    except Exception as error:
+        logger.warning("Opening the mail connection failed: %s", error)
+        return error
+    return None
+
+
+def drain(connection=None, batch_size: int = None) -> int:
+    """
+    Sends one batch of due emails and returns how many were sent, when the
+    connection cannot be opened the rest of the batch is retried later
+    """
+    batch_size = settings.OUTBOX_BATCH_SIZE if batch_size is None else batch_size
+    connection = get_connection() if connection is None else connection
+    with transaction.atomic():
+        emails = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(
+                sent__isnull=True,
+                next_attempt__lte=now(),
+                attempts__lt=settings.OUTBOX_MAX_ATTEMPTS,
+            )
+            .order_by("id")[:batch_size]
+        )
+        if not emails:
+            return 0
+        error = open_connection(connection)
+        sent = 0
+        for email in emails:
+            if error is not None:
+                retry_later(email, error)
+                continue
+            try:
+                connection.send_messages(
+                    [
+                        EmailMessage(
+                            email.subject,
+                            email.message,
+                            email.from_email,
+                            email.recipients,
+                            connection=connection,
+                        )
+                    ]
+                )
+            except Exception as send_error:
+                logger.warning(
+                    "Sending outbox email %s failed: %s", email.id, send_error
+                )
+                retry_later(email, send_error)
+                error = open_connection(connection, reopen=True)
+            else:
+                email.sent = now()
+                sent += 1
+        OutboxEmail.objects.bulk_update(
+            emails, ["attempts", "error", "next_attempt", "sent"]
+        )
+    return sent
+
+
+def send(stop: threading.Event = None, interval: float = None) -> None:
+    """
+    Drains the outbox until stopped, keeping the mail connection open while
+    there is mail to send
+    """
+    interval = settings.OUTBOX_POLL_INTERVAL if interval is None else interval
+    connection = get_connection()
+    stop = threading.Event() if stop is None else stop
+    while not stop.is_set():
+        try:
+            sent = drain(connection)
+        except Exception:
+            logger.exception("Draining the outbox failed")
+            sent = 0
+        close_old_connections()
+        if not sent:
+            connection.close()
+            stop.wait(interval)
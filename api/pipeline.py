@@ -0,0 +1,294 @@
+import cv2
+import threading
+import numpy as np
+
+from PIL import Image
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+"""
+Face pipeline
+
+Detects and aligns every face of an image once, the crops and their
+embeddings are then reused by the face check, the gallery search and
+enrollment
+"""
+
+DETECTOR_BACKEND = "mtcnn"
+DETECTOR_STATS_KEY = "detector-stats"
+
+
+def embedder_backend():
+    return import_string(settings.EMBEDDER_BACKEND)
+
+
+class Face(object):
+    def __init__(self, crop: np.ndarray, region: list, embedding: np.ndarray = None):
+        self.crop = crop
+        self.region = region
+        self.embedding = embedding
+
+    @property
+    def area(self) -> int:
+        return self.region[2] * self.region[3]
+
+
+class DetectorStats(object):
+    """
+    Shared counters of how often each detection stage found a face, read
+    with `manage.py detector_stats`
+    """
+
+    stages = ("opencv", "mtcnn")
+    outcomes = ("hit", "miss")
+
+    @staticmethod
+    def key(stage: str, outcome: str) -> str:
+        return f"{DETECTOR_STATS_KEY}:{stage}:{outcome}"
+
+    @classmethod
+    def record(cls, stage: str, outcome: str) -> None:
+        from django.core.cache import cache
+
+        key = cls.key(stage, outcome)
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+    @classmethod
+    def get(cls) -> dict:
+        from django.core.cache import cache
+
+        keys = [cls.key(s, o) for s in cls.stages for o in cls.outcomes]
+        counts = cache.get_many(keys)
+        stats = {}
+        for stage in cls.stages:
+            hits = counts.get(cls.key(stage, "hit"), 0)
+            misses = counts.get(cls.key(stage, "miss"), 0)
+            stats[stage] = {
+                "runs": hits + misses,
+                "hits": hits,
+                "hit_rate": hits / (hits + misses) if hits + misses else None,
+            }
+        return stats
+
+    @classmethod
+    def reset(cls) -> None:
+        from django.core.cache import cache
+
+        cache.delete_many([cls.key(s, o) for s in cls.stages for o in cls.outcomes])
+
+
+class FacePipeline(object):
+    __detector = None
+    __fast_detector = None
+    __embedder = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def detector(cls):
+        with cls.__lock:
+            if cls.__detector is None:
+                from deepface.detectors import FaceDetector
+
+                cls.__detector = FaceDetector.build_model(DETECTOR_BACKEND)
+        return cls.__detector
+
+    @classmethod
+    def fast_detector(cls):
+        with cls.__lock:
+            if cls.__fast_detector is None:
+                cls.__fast_detector = (
+                    cv2.CascadeClassifier(
+                        cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+                    ),
+                    cv2.CascadeClassifier(
+                        cv2.data.haarcascades + "haarcascade_eye.xml"
+                    ),
+                )
+        return cls.__fast_detector
+
+    @classmethod
+    def embedder(cls):
+        with cls.__lock:
+            if cls.__embedder is None:
+                cls.__embedder = embedder_backend()()
+        return cls.__embedder
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls.__lock:
+            cls.__detector = None
+            cls.__fast_detector = None
+            cls.__embedder = None
+
+    @classmethod
+    def warm_up(cls) -> None:
+        """
+        Builds the detector and embedder and runs one inference through each
+        so the first request does not pay for graph construction
+        """
+        cls.fast_detector()
+        cls.detect_mtcnn(np.zeros((160, 160, 3), dtype=np.uint8))
+        cls.embed([Face(np.zeros((112, 112, 3), dtype=np.uint8), [0, 0, 112, 112])])
+
+    @classmethod
+    def detect(cls, img: np.ndarray, max_side: int = None) -> list:
+        """
+        Aligned faces of the image, largest first, found on a copy at most
+        max_side pixels long, DETECTION_MAX_SIDE by default. With
+        DETECTOR_CASCADE the OpenCV cascade runs first and MTCNN only when it
+        finds no face at DETECTOR_FAST_CONFIDENCE
+        """
+        if settings.DETECTOR_CASCADE:
+            faces = cls.detect_fast(img, max_side)
+            DetectorStats.record("opencv", "hit" if faces else "miss")
+            if faces:
+                return faces
+        faces = cls.detect_mtcnn(img, max_side)
+        DetectorStats.record("mtcnn", "hit" if faces else "miss")
+        return faces
+
+    @classmethod
+    def detect_fast(cls, img: np.ndarray, max_side: int = None) -> list:
+        from deepface.detectors import OpenCvWrapper
+
+        face_detector, eye_detector = cls.fast_detector()
+        small, scale = bounded(img, max_side)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        min_size = max(30, int(min(gray.shape) * settings.DETECTOR_FAST_MIN_SIZE))
+        boxes, _, weights = face_detector.detectMultiScale3(
+            gray,
+            scaleFactor=1.1,
+            minNeighbors=10,
+            minSize=(min_size, min_size),
+            outputRejectLevels=True,
+        )
+        faces = []
+        for box, weight in zip(boxes, np.ravel(weights)):
+            if weight < settings.DETECTOR_FAST_CONFIDENCE:
+                continue
+            region = original_region(box, scale, img.shape)
+            x, y, w, h = region
+            crop = OpenCvWrapper.align_face(eye_detector, img[y : y + h, x : x + w])
+            faces.append(Face(crop, region))
+        return sorted(faces, key=lambda face: face.area, reverse=True)
+
+    @classmethod
+    def detect_mtcnn(cls, img: np.ndarray, max_side: int = None) -> list:
+        """
+        MTCNN on the bounded image, boxes and eyes are scaled back so faces
+        are cropped and aligned from the decoded image
+        """
+        from deepface.detectors import FaceDetector
+
+        small, scale = bounded(img, max_side)
+        faces = []
+        for detection in cls.detector().detect_faces(
+            cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        ):
+            region = original_region(detection["box"], scale, img.shape)
+            x, y, w, h = region
+            crop = img[y : y + h, x : x + w]
+            if not crop.size:
+                continue
+            keypoints = detection["keypoints"]
+            crop = FaceDetector.alignment_procedure(
+                crop,
+                [c / scale for c in keypoints["left_eye"]],
+                [c / scale for c in keypoints["right_eye"]],
+            )
+            faces.append(Face(crop, region))
+        return sorted(faces, key=lambda face: face.area, reverse=True)
+
+    @classmethod
+    def embed(cls, faces: list) -> list:
+        """
+        Fills in the embedding of every face with one batched forward pass
+        """
+        if not faces:
+            return faces
+        embedder = cls.embedder()
+        batch = np.stack(
+            [preprocess(face.crop, embedder.input_shape) for face in faces]
+        )
+        for face, embedding in zip(faces, embedder.embed(batch)):
+            face.embedding = np.asarray(embedding, dtype=np.float32)
+        return faces
+
+    @classmethod
+    def process(cls, img: np.ndarray, max_side: int = None) -> list:
+        return cls.embed(cls.detect(img, max_side))
+
+
+def bounded(img: np.ndarray, max_side: int = None) -> tuple:
+    """
+    The image shrunk so its longer side is at most DETECTION_MAX_SIDE and the
+    scale applied
+    """
+    max_side = settings.DETECTION_MAX_SIDE if max_side is None else max_side
+    scale = min(1.0, max_side / max(img.shape[:2]))
+    if scale == 1.0:
+        return img, scale
+    return (
+        cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA),
+        scale,
+    )
+
+
+def original_region(box, scale: float, shape: tuple) -> list:
+    """
+    Box found on the bounded image in the image's own pixels, clipped to it
+    """
+    x, y, w, h = [int(round(c / scale)) for c in box]
+    x, y = max(x, 0), max(y, 0)
+    return [x, y, min(w, shape[1] - x), min(h, shape[0] - y)]
+
+
+def decode_flag(source) -> int:
+    """
+    imread flag decoding the JPEG at source, a path or file, at the largest
+    DCT reduction keeping its longer side at least DECODE_MIN_SIDE
+    """
+    try:
+        with Image.open(source) as header:
+            if header.format != "JPEG":
+                return cv2.IMREAD_COLOR
+            side = max(header.size)
+    except Exception:
+        return cv2.IMREAD_COLOR
+    for factor, flag in (
+        (8, cv2.IMREAD_REDUCED_COLOR_8),
+        (4, cv2.IMREAD_REDUCED_COLOR_4),
+        (2, cv2.IMREAD_REDUCED_COLOR_2),
+    ):
+        if side / factor >= settings.DECODE_MIN_SIDE:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def read_image(path: str) -> np.ndarray:
+    return cv2.imread(path, decode_flag(path))
+
+
+def preprocess(crop: np.ndarray, target_size: tuple) -> np.ndarray:
+    """
+    Resizes keeping aspect ratio and pads to the model input the same way
+    DeepFace does before representing a face
+    """
+    factor = min(target_size[0] / crop.shape[0], target_size[1] / crop.shape[1])
+    crop = cv2.resize(crop, (int(crop.shape[1] * factor), int(crop.shape[0] * factor)))
+    diff_0 = target_size[0] - crop.shape[0]
+    diff_1 = target_size[1] - crop.shape[1]
+    crop = np.pad(
+        crop,
+        (
+            (diff_0 // 2, diff_0 - diff_0 // 2),
+            (diff_1 // 2, diff_1 - diff_1 // 2),
+            (0, 0),
+        ),
+        "constant",
+    )
+    if crop.shape[0:2] != tuple(target_size):
+        crop = cv2.resize(crop, (target_size[1], target_size[0]))
+    return crop.astype(np.float32) / 255
@@ -1,11 +1,16 @@
-from uuid import uuid4
-
-from rest_framework.serializers import ModelSerializer, ValidationError, Serializer
+from rest_framework.serializers import (
+    CharField,
+    IntegerField,
+    ListSerializer,
+    ModelSerializer,
+    PrimaryKeyRelatedField,
+    ValidationError,
+    Serializer,
+)
 
 from django.conf import settings
 
 from api.model import Students, Attendance
-from api.utils import TokenHandler
 
 
 class StudentSerializer(ModelSerializer):
@@ -35,23 +40,82 @@ class StudentSerializer(ModelSerializer):
         return instance
 
 
+class StudentField(PrimaryKeyRelatedField):
+    """
+    Looks students up in the "students" context prefetched by
+    AttendanceListSerializer instead of one query per row
+    """
+
+    def to_internal_value(self, data):
+        students = self.context.get("students")
+        if students is None:
+            return super().to_internal_value(data)
+        try:
+            return students[int(data)]
+        except (KeyError, TypeError, ValueError):
+            self.fail("does_not_exist", pk_value=data)
+
+
+class AttendanceListSerializer(ListSerializer):
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            ids = set()
+            for row in data:
+                try:
+                    ids.add(int(row["student"]))
+                except (KeyError, TypeError, ValueError):
+                    pass
+            self.context["students"] = Students.objects.in_bulk(ids)
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        return Attendance.objects.bulk_create(
+            [
+                Attendance(
+                    student=attendance["student"],
+                    subject=attendance["subject"],
+                )
+                for attendance in validated_data
+            ]
+        )
+
+
 class AttendanceSerializer(ModelSerializer):
+    student = StudentField(queryset=Students.objects.all())
+
     class Meta:
         model = Attendance
-        fields = ('student', 'subject')
+        fields = ("student", "subject")
+        list_serializer_class = AttendanceListSerializer
 
     def create(self, validated_data):
-        attendance = Attendance.objects.create(
-            student=validated_data['student'],
-            subject=validated_data['subject'],
-            token=str(uuid4())
+        return Attendance.objects.create(
+            student=validated_data["student"],
+            subject=validated_data["subject"],
         )
-        attendance.save()
-        return attendance
 
 
-class ConfirmAttendanceSerializer(Serializer):
-    def update(self, instance, validated_data=None):
-        instance.confirmed = True
-        instance.save()
-        return instance
+class AttendanceRosterSerializer(Serializer):
+    """
+    Opens attendance of a subject for every student of a field of study and
+    year with one select and one insert
+    """
+
+    subject = CharField(max_length=50)
+    field_of_study = CharField(max_length=50)
+    year = IntegerField()
+
+    def create(self, validated_data):
+        students = Students.objects.filter(
+            field_of_study=validated_data["field_of_study"],
+            year=validated_data["year"],
+        ).values_list("id", flat=True)
+        return Attendance.objects.bulk_create(
+            [
+                Attendance(
+                    student_id=student,
+                    subject=validated_data["subject"],
+                )
+                for student in students
+            ]
+        )
@@ -1,3 +1,1467 @@
-from django.test import TestCase
+import cv2
+import json
+import multiprocessing
+import numpy as np
+import os
+import pickle
+import shutil
+import tempfile
 
-# Create your tests here.
+from importlib.util import find_spec
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
+
+from django.apps import apps
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APITestCase
+
+from user.models import User
+
+from .gallery import (
+    EmbeddingIndex,
+    GALLERY_LOCK_FILE,
+    GALLERY_VERSION,
+    GalleryPolicy,
+    GalleryRows,
+    GalleryStore,
+    IVFIndex,
+    IVF_FILE,
+    Int8Index,
+    LEGACY_REPRESENTATIONS_FILE,
+    PROTOTYPE_FILE,
+    PrototypeIndex,
+    build_representations,
+    bump_gallery_version,
+    distance_delta,
+    identity_name,
+    int8_codes,
+    prototype_sums,
+    recall_at_k,
+)
+from . import benchmark, outbox, tokens
+from . import inference
+from .inference import InferencePool
+from .jobs import JobQueueHandler, process
+from .model import Students, Attendance, OutboxEmail
+from .utils import BKTree, DuplicateRemover, RecognitionCache, decode_image
+from .embedders import DeepFaceEmbedder, ONNXEmbedder, StubEmbedder
+from .pipeline import DetectorStats, Face, FacePipeline, preprocess
+
+
+def jpeg_upload(name="upload.jpg"):
+    _, data = cv2.imencode(".jpg", np.zeros((8, 8, 3), dtype=np.uint8))
+    return SimpleUploadedFile(name, data.tobytes(), content_type="image/jpeg")
+
+
+def random_gallery(rows, dim=512, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((rows, dim)).astype(np.float32)
+
+
+def add_rows(ref_root, worker, rows):
+    store = GalleryStore(ref_root)
+    for i in range(rows):
+        embedding = random_gallery(1, seed=1000 * worker + i)[0]
+        store.add(f"/db/Student {worker}/{i}.jpg", embedding, worker)
+
+
+class EmbeddingIndexTest(TestCase):
+    def setUp(self):
+        self.embeddings = random_gallery(50)
+        self.identities = [f"/db/Student {i}/{i}.jpg" for i in range(50)]
+        self.index = EmbeddingIndex(self.identities, self.embeddings)
+
+    def test_matrix_is_contiguous_float32(self):
+        self.assertEqual(np.float32, self.index.matrix.dtype)
+        self.assertTrue(self.index.matrix.flags["C_CONTIGUOUS"])
+
+    def test_search_finds_exact_match_first(self):
+        matches = self.index.search(self.embeddings[7])
+        self.assertEqual(self.identities[7], matches[0][0])
+        self.assertAlmostEqual(0.0, matches[0][1], places=5)
+
+    def test_search_respects_threshold_and_k(self):
+        query = self.embeddings[3] + 0.1 * self.embeddings[4]
+        self.assertEqual(1, len(self.index.search(query, threshold=0.2)))
+        self.assertEqual(5, len(self.index.search(query, k=5, threshold=2)))
+
+    def test_search_matches_brute_force(self):
+        query = self.embeddings[11]
+        matches = self.index.search(query, threshold=2)
+        expected = [
+            1 - np.dot(row, query) / (np.linalg.norm(row) * np.linalg.norm(query))
+            for row in self.embeddings
+        ]
+        self.assertEqual(len(self.identities), len(matches))
+        np.testing.assert_allclose(
+            sorted(expected), [distance for _, distance in matches], atol=1e-5
+        )
+
+    def test_search_many_matches_search(self):
+        queries = self.embeddings[:5] + 0.1 * self.embeddings[5:10]
+        for query, matches in zip(queries, self.index.search_many(queries, k=3)):
+            expected = self.index.search(query, k=3)
+            self.assertEqual([i for i, _ in expected], [i for i, _ in matches])
+            np.testing.assert_allclose(
+                [d for _, d in expected], [d for _, d in matches], atol=1e-5
+            )
+
+    def test_empty_index(self):
+        self.assertEqual([], EmbeddingIndex().search(self.embeddings[0]))
+
+    def test_identity_name(self):
+        self.assertEqual("Bill Gates", identity_name("/db/Bill Gates/Bill1.jpg"))
+
+
+class GalleryStoreTest(TestCase):
+    def setUp(self):
+        self.ref_root = tempfile.mkdtemp()
+        self.embeddings = random_gallery(3)
+        self.store = GalleryStore(self.ref_root)
+        self.store.write(
+            [f"/db/Student {i}/{i}.jpg" for i in range(2)], self.embeddings[:2]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.ref_root)
+
+    def test_add_appends_single_image(self):
+        self.store.add("/db/Student 2/2.jpg", self.embeddings[2])
+        index = EmbeddingIndex.load(self.store)
+        self.assertEqual(3, len(index))
+        self.assertEqual("/db/Student 2/2.jpg", index.search(self.embeddings[2])[0][0])
+
+    def test_update_replaces_embedding(self):
+        self.store.update("/db/Student 0/0.jpg", self.embeddings[2])
+        index = EmbeddingIndex.load(self.store)
+        self.assertEqual(2, len(index))
+        self.assertEqual("/db/Student 0/0.jpg", index.search(self.embeddings[2])[0][0])
+
+    def test_delete_removes_image(self):
+        self.store.delete("/db/Student 0/0.jpg")
+        self.assertEqual(
+            ["/db/Student 1/1.jpg"], list(EmbeddingIndex.load(self.store).identities)
+        )
+
+    def test_matrix_is_memory_mapped(self):
+        index = EmbeddingIndex.load(self.store)
+        self.assertIsInstance(index.matrix, np.memmap)
+        self.assertEqual(np.float32, index.matrix.dtype)
+
+    def test_add_grows_past_capacity(self):
+        for i in range(100):
+            self.store.add(f"/db/Student 3/{i}.jpg", random_gallery(1, seed=i)[0])
+        index = EmbeddingIndex.load(self.store)
+        self.assertEqual(102, len(index))
+        self.assertEqual("/db/Student 1/1.jpg", index.search(self.embeddings[1])[0][0])
+        self.assertEqual(2, self.store.sidecar()["generation"])
+
+    def test_concurrent_writers_keep_every_row(self):
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(target=add_rows, args=(self.ref_root, worker, 20))
+            for worker in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([0, 0, 0, 0], [worker.exitcode for worker in workers])
+        identities, matrix = self.store.load()
+        self.assertEqual(82, len(identities))
+        for identity, row in zip(identities[2:], matrix[2:]):
+            name, image = identity.split("/")[-2:]
+            seed = 1000 * int(name.split()[-1]) + int(image.split(".")[0])
+            expected = random_gallery(1, seed=seed)[0]
+            np.testing.assert_allclose(
+                expected / np.linalg.norm(expected), row, atol=1e-6
+            )
+        self.assertEqual(
+            [GALLERY_LOCK_FILE],
+            [name for name in os.listdir(self.ref_root) if name.startswith(".")],
+        )
+        self.assertFalse(
+            [name for name in os.listdir(self.ref_root) if name.endswith(".tmp")]
+        )
+
+    def test_delete_tombstones_rows_in_place(self):
+        for i in range(6):
+            self.store.add(f"/db/Student 2/{i}.jpg", random_gallery(1, seed=i)[0])
+        matrix = self.store.sidecar()["matrix"]
+        self.store.delete("/db/Student 2/1.jpg", "/db/Student 0/0.jpg")
+        sidecar = self.store.sidecar()
+        self.assertEqual(matrix, sidecar["matrix"])
+        rows = self.store.rows(sidecar)
+        self.assertIsNone(rows[0])
+        self.assertEqual(2, sidecar["deleted"])
+        self.assertEqual([], rows.rows("Student 0"))
+        self.assertEqual([1], rows.rows("Student 1"))
+        self.assertEqual([2, 4, 5, 6, 7], rows.rows("Student 2"))
+        index = EmbeddingIndex.load(self.store)
+        self.assertEqual(8, len(index))
+        self.assertNotIn(
+            None, [i for i, _ in index.search(self.embeddings[0], threshold=2)]
+        )
+        self.assertEqual(6, len(index.search(self.embeddings[0], threshold=2)))
+        self.assertFalse(self.store.matrix(sidecar)[0].any())
+
+    def test_compacts_once_too_many_rows_are_deleted(self):
+        for i in range(6):
+            self.store.add(f"/db/Student 2/{i}.jpg", random_gallery(1, seed=i)[0])
+        self.store.delete("/db/Student 2/0.jpg", "/db/Student 2/1.jpg")
+        self.store.delete("/db/Student 2/2.jpg")
+        sidecar = self.store.sidecar()
+        self.assertEqual(2, sidecar["generation"])
+        self.assertEqual(0, sidecar["deleted"])
+        self.assertEqual(
+            ["/db/Student 0/0.jpg", "/db/Student 1/1.jpg"]
+            + [f"/db/Student 2/{i}.jpg" for i in range(3, 6)],
+            self.store.load()[0],
+        )
+        self.assertEqual(
+            self.store.load()[0][2],
+            EmbeddingIndex.load(self.store).search(random_gallery(1, seed=3)[0])[0][0],
+        )
+
+    def test_migrates_legacy_pickle(self):
+        shutil.rmtree(self.ref_root)
+        os.mkdir(self.ref_root)
+        with open(os.path.join(self.ref_root, LEGACY_REPRESENTATIONS_FILE), "wb") as f:
+            pickle.dump([["/db/Bill Gates/Bill1.jpg", self.embeddings[0].tolist()]], f)
+        identities, matrix = self.store.load()
+        self.assertEqual(["/db/Bill Gates/Bill1.jpg"], identities)
+        self.assertIsNone(
+            self.store.rows(self.store.sidecar()).student("/db/Bill Gates/Bill1.jpg")
+        )
+
+    def test_rows_are_keyed_by_student(self):
+        student = Students.objects.create(
+            first_name="Mary Ann", last_name="Smith", year=1, field_of_study="CS"
+        )
+        self.store.add("/db/Mary Ann Smith/0.jpg", self.embeddings[2])
+        rows = self.store.rows(self.store.sidecar())
+        self.assertEqual(student.id, rows.student("/db/Mary Ann Smith/0.jpg"))
+        self.store.delete("/db/Student 0/0.jpg")
+        rows = self.store.rows(self.store.sidecar())
+        self.assertEqual([None, student.id], rows.students([0, 1]))
+
+    def test_add_appends_rows_next_to_the_sidecar(self):
+        self.store.add("/db/Student 2/2.jpg", self.embeddings[2])
+        for i in range(20):
+            self.store.add(f"/db/Student {i}/{i}.jpg", random_gallery(1, seed=i)[0])
+        with open(self.store.path) as f:
+            self.assertEqual(
+                {
+                    "version",
+                    "model",
+                    "generation",
+                    "matrix",
+                    "count",
+                    "names_size",
+                    "deleted",
+                    "revision",
+                },
+                set(json.load(f)),
+            )
+        rows = self.store.rows(self.store.sidecar())
+        self.assertEqual(23, len(rows))
+        self.assertEqual("/db/Student 19/19.jpg", rows[22])
+        self.assertEqual([0, 3], rows.rows("Student 0"))
+
+    def test_reload_ignores_rows_past_the_committed_count(self):
+        sidecar = self.store.sidecar()
+        end = int(self.store.rows(sidecar).offsets[-1])
+        self.store.append(sidecar, "paths", end, b"/db/Student 9/torn.jpg")
+        self.store.add("/db/Student 2/2.jpg", self.embeddings[2])
+        self.assertEqual(
+            ["/db/Student 0/0.jpg", "/db/Student 1/1.jpg", "/db/Student 2/2.jpg"],
+            self.store.load()[0],
+        )
+
+    def write_legacy_sidecar(self, version: int, rows: list, **fields):
+        sidecar = self.store.sidecar()
+        with open(self.store.path, "w") as f:
+            json.dump(
+                {
+                    "version": version,
+                    "model": sidecar["model"],
+                    "generation": sidecar["generation"],
+                    "matrix": sidecar["matrix"],
+                    "rows": rows,
+                    **fields,
+                },
+                f,
+            )
+
+    def test_upgrades_name_keyed_sidecar(self):
+        student = Students.objects.create(
+            first_name="Student", last_name="1", year=1, field_of_study="CS"
+        )
+        self.write_legacy_sidecar(
+            1,
+            [
+                [identity_name(i), i]
+                for i in ("/db/Student 0/0.jpg", "/db/Student 1/1.jpg")
+            ],
+        )
+        sidecar = self.store.sidecar()
+        self.assertEqual(GALLERY_VERSION, sidecar["version"])
+        self.assertEqual([None, student.id], self.store.rows(sidecar).students([0, 1]))
+
+    def test_upgrades_sidecar_listing_rows(self):
+        self.store.add("/db/Student 2/2.jpg", self.embeddings[2])
+        self.write_legacy_sidecar(
+            3,
+            [[None, None], [4, "/db/Student 1/1.jpg"], [None, "/db/Student 2/2.jpg"]],
+            folders={"Student 1": [1], "Student 2": [2]},
+            deleted=1,
+            revision=7,
+        )
+        sidecar = self.store.sidecar()
+        self.assertEqual(0, sidecar["deleted"])
+        self.assertEqual(8, sidecar["revision"])
+        self.assertEqual(
+            ["/db/Student 1/1.jpg", "/db/Student 2/2.jpg"], self.store.load()[0]
+        )
+        self.assertEqual([4, None], self.store.rows(sidecar).students([0, 1]))
+        self.assertEqual(
+            "/db/Student 2/2.jpg",
+            EmbeddingIndex.load(self.store).search(self.embeddings[2])[0][0],
+        )
+
+
+@override_settings(GALLERY_MAX_IMAGES=3, GALLERY_MIN_DIVERSITY=0.1)
+class GalleryPolicyTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.ref_root = tempfile.mkdtemp()
+        self.folder = os.path.join(self.ref_root, "Student 0")
+        os.mkdir(self.folder)
+        self.embeddings = random_gallery(5)
+        self.identities = [os.path.join(self.folder, f"{i}.jpg") for i in range(3)]
+        for identity in self.identities:
+            open(identity, "wb").close()
+        self.store = GalleryStore(self.ref_root)
+        self.store.write(self.identities, self.embeddings[:3])
+        self.policy = GalleryPolicy(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.ref_root)
+
+    def test_admits_only_diverse_images(self):
+        self.assertFalse(self.policy.admit("Student 0", self.embeddings[0] + 0.01))
+        self.assertTrue(self.policy.admit("Student 0", self.embeddings[3]))
+        self.assertTrue(self.policy.admit("Student 1", self.embeddings[0]))
+
+    def test_counts_hits(self):
+        for _ in range(3):
+            self.policy.hit(self.identities[1])
+        self.assertEqual([0, 3, 0], self.policy.hits(self.identities).tolist())
+
+    def test_evicts_redundant_unused_images_over_the_limit(self):
+        self.assertEqual([], self.policy.evict("Student 0"))
+        redundant = self.embeddings[0] + 0.1 * self.embeddings[4]
+        open(os.path.join(self.folder, "3.jpg"), "wb").close()
+        for _ in range(5):
+            self.policy.hit(self.identities[0])
+
+        evicted = self.policy.enroll(os.path.join(self.folder, "3.jpg"), redundant)
+        self.assertEqual([os.path.join(self.folder, "3.jpg")], evicted)
+        self.assertFalse(os.path.exists(evicted[0]))
+        self.assertEqual(self.identities + [None], self.store.load()[0])
+        self.assertEqual(
+            [0, 1, 2], self.store.rows(self.store.sidecar()).rows("Student 0")
+        )
+
+    def test_admits_against_the_resident_index(self):
+        index = EmbeddingIndex.load(self.store)
+        policy = GalleryPolicy(self.store, index)
+        self.store.add(os.path.join(self.folder, "3.jpg"), self.embeddings[3])
+        with patch("api.gallery.GalleryStore.sidecar") as sidecar:
+            self.assertTrue(policy.admit("Student 0", self.embeddings[3]))
+            self.assertFalse(policy.admit("Student 0", self.embeddings[2]))
+        sidecar.assert_not_called()
+
+
+class IVFIndexTest(TestCase):
+    def setUp(self):
+        self.ref_root = tempfile.mkdtemp()
+        self.embeddings = random_gallery(500)
+        self.store = GalleryStore(self.ref_root)
+        self.store.write(
+            [f"/db/Student {i}/{i}.jpg" for i in range(500)], self.embeddings
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.ref_root)
+
+    def test_full_probe_matches_exact_search(self):
+        exact = EmbeddingIndex.load(self.store)
+        ivf = IVFIndex(
+            exact.identities, exact.matrix, normalized=True, lists=16, probes=16
+        )
+        self.assertEqual(1.0, recall_at_k(ivf, exact, self.embeddings[:20], k=5))
+
+    def test_finds_stored_embedding(self):
+        with self.settings(GALLERY_IVF_LISTS=16, GALLERY_IVF_PROBES=2):
+            ivf = IVFIndex.load(self.store)
+        self.assertEqual("/db/Student 42/42.jpg", ivf.search(self.embeddings[42])[0][0])
+
+    def test_persisted_and_updated_online(self):
+        with self.settings(GALLERY_IVF_LISTS=16, GALLERY_IVF_PROBES=2):
+            IVFIndex.load(self.store)
+            self.assertTrue(os.path.exists(os.path.join(self.ref_root, IVF_FILE)))
+            embedding = random_gallery(1, seed=7)[0]
+            self.store.add("/db/Student new/new.jpg", embedding)
+            ivf = IVFIndex.load(self.store)
+        self.assertEqual(501, len(ivf.assignments))
+        self.assertEqual("/db/Student new/new.jpg", ivf.search(embedding)[0][0])
+
+    def test_centroids_are_retrained_after_drift(self):
+        with self.settings(GALLERY_IVF_LISTS=16, GALLERY_IVF_PROBES=2):
+            centroids = IVFIndex.load(self.store).centroids
+            for i, embedding in enumerate(random_gallery(500, seed=5)):
+                self.store.add(f"/db/Student {i}/new.jpg", embedding)
+            ivf = IVFIndex.load(self.store)
+            np.testing.assert_allclose(centroids, ivf.centroids, atol=1e-6)
+            self.assertEqual(500, ivf.trained)
+
+            self.store.add("/db/Student 0/last.jpg", random_gallery(1, seed=6)[0])
+            ivf = IVFIndex.load(self.store)
+        self.assertEqual(1001, ivf.trained)
+        self.assertFalse(np.allclose(centroids, ivf.centroids, atol=1e-3))
+        with np.load(os.path.join(self.ref_root, IVF_FILE)) as saved:
+            self.assertEqual(1001, int(saved["trained"]))
+            np.testing.assert_allclose(ivf.centroids, saved["centroids"], atol=1e-6)
+
+    def test_centroids_are_retrained_when_lists_change(self):
+        with self.settings(GALLERY_IVF_LISTS=16):
+            IVFIndex.load(self.store)
+        with self.settings(GALLERY_IVF_LISTS=8):
+            self.assertEqual(8, len(IVFIndex.load(self.store).centroids))
+
+
+class QuantizedIndexTest(TestCase):
+    def setUp(self):
+        centres = random_gallery(50)
+        noise = random_gallery(500, seed=1) * 0.05
+        self.embeddings = np.repeat(centres, 10, axis=0) + noise
+        self.identities = [f"/db/Student {i // 10}/{i}.jpg" for i in range(500)]
+        self.exact = EmbeddingIndex(self.identities, self.embeddings)
+        self.queries = self.embeddings[::25] + random_gallery(20, seed=2) * 0.02
+
+    def test_int8_codes_are_a_quarter_of_the_matrix(self):
+        index = Int8Index(self.identities, self.embeddings)
+        self.assertEqual(np.int8, index.codes.dtype)
+        self.assertEqual(self.exact.matrix.nbytes / 4, index.codes.nbytes)
+
+    def test_reranked_results_match_exact_search(self):
+        index = Int8Index(self.identities, self.embeddings, rerank=20)
+        self.assertEqual(1.0, recall_at_k(index, self.exact, self.queries, k=10))
+        self.assertAlmostEqual(
+            0.0, distance_delta(index, self.exact, self.queries), places=5
+        )
+        expected = self.exact.search(self.queries[0])
+        found = index.search(self.queries[0])
+        self.assertEqual([i for i, _ in expected], [i for i, _ in found])
+        np.testing.assert_allclose(
+            [d for _, d in expected], [d for _, d in found], atol=1e-6
+        )
+
+    def test_codes_are_memory_mapped_and_maintained(self):
+        ref_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ref_root)
+        store = GalleryStore(ref_root)
+        store.write(self.identities, self.embeddings)
+        index = Int8Index.load(store)
+        self.assertIsInstance(index.codes, np.memmap)
+        embedding = random_gallery(1, seed=9)[0]
+        store.add("/db/Student new/new.jpg", embedding)
+        store.delete(self.identities[0])
+
+        with patch("api.gallery.int8_scales") as fit:
+            index = Int8Index.load(store)
+        fit.assert_not_called()
+        codes = np.asarray(index.codes)
+        np.testing.assert_array_equal(int8_codes(index.matrix, index.scales), codes)
+        self.assertFalse(codes[0].any())
+        self.assertEqual("/db/Student new/new.jpg", index.search(embedding)[0][0])
+        self.assertNotIn(
+            self.identities[0],
+            [i for i, _ in index.search(self.embeddings[0], k=5, threshold=2)],
+        )
+
+    def test_search_many_matches_search(self):
+        index = Int8Index(self.identities, self.embeddings)
+        self.assertEqual(
+            [index.search(query, k=3) for query in self.queries],
+            index.search_many(self.queries, k=3),
+        )
+
+
+class PrototypeIndexTest(TestCase):
+    def setUp(self):
+        centres = random_gallery(20)
+        noise = random_gallery(200, seed=1) * 0.02
+        self.embeddings = np.repeat(centres, 10, axis=0) + noise
+        self.identities = [f"/db/Student {i // 10}/{i}.jpg" for i in range(200)]
+
+    def test_one_prototype_per_student(self):
+        index = PrototypeIndex(self.identities, self.embeddings, shortlist=2)
+        self.assertEqual(20, len(index.centroids))
+        self.assertEqual(20, len(index.names))
+        self.assertIsNone(index.student(self.identities[0]))
+        self.assertEqual(20, len(index.candidates(index.matrix[0])))
+
+    def test_shortlist_matches_exact_search(self):
+        exact = EmbeddingIndex(self.identities, self.embeddings)
+        index = PrototypeIndex(self.identities, self.embeddings, shortlist=2)
+        self.assertEqual(1.0, recall_at_k(index, exact, self.embeddings[::7], k=10))
+
+    def test_sums_are_persisted_and_maintained(self):
+        ref_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ref_root)
+        store = GalleryStore(ref_root)
+        store.write(self.identities, self.embeddings)
+        PrototypeIndex.load(store)
+        self.assertTrue(os.path.exists(os.path.join(ref_root, PROTOTYPE_FILE)))
+        store.add("/db/Student 3/new.jpg", self.embeddings[0])
+        embedding = random_gallery(1, seed=9)[0]
+        store.add("/db/Student new/new.jpg", embedding)
+        store.delete("/db/Student 5/50.jpg", "/db/Student 5/51.jpg")
+
+        with patch("api.gallery.prototype_sums") as rebuild:
+            index = PrototypeIndex.load(store)
+        rebuild.assert_not_called()
+        names, sums, counts = prototype_sums(index.matrix, index.identities)
+        self.assertEqual(names, index.names)
+        np.testing.assert_allclose(sums, index.sums, atol=1e-5)
+        self.assertEqual(counts.tolist(), index.counts.tolist())
+        self.assertEqual("/db/Student new/new.jpg", index.search(embedding)[0][0])
+
+
+class PipelineTest(TestCase):
+    def test_preprocess_pads_to_model_input(self):
+        crop = np.full((200, 100, 3), 255, dtype=np.uint8)
+        pixels = preprocess(crop, (112, 112))
+        self.assertEqual((112, 112, 3), pixels.shape)
+        self.assertEqual(1.0, pixels[56, 56, 0])
+        self.assertEqual(0.0, pixels[56, 0, 0])
+
+    def test_face_area(self):
+        self.assertEqual(200, Face(None, [5, 5, 10, 20]).area)
+
+
+@override_settings(DETECTOR_CASCADE=True)
+class CascadeDetectorTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        FacePipeline.reset()
+
+    def test_frontal_face_skips_mtcnn(self):
+        img = cv2.imread(
+            os.path.join(settings.BASE_DIR, "database/Elon Musk/Elon3.jpg")
+        )
+        with patch("api.pipeline.FacePipeline.detect_mtcnn") as mtcnn:
+            faces = FacePipeline.detect(img)
+        mtcnn.assert_not_called()
+        self.assertEqual(1, len(faces))
+        x, y, w, h = faces[0].region
+        self.assertTrue(200 < x + w / 2 < 330 and 80 < y + h / 2 < 200)
+        self.assertEqual(1, DetectorStats.get()["opencv"]["hits"])
+
+    def test_falls_back_to_mtcnn(self):
+        img = np.zeros((160, 160, 3), dtype=np.uint8)
+        face = Face(img, [0, 0, 160, 160])
+        with patch("api.pipeline.FacePipeline.detect_mtcnn", return_value=[face]):
+            self.assertEqual([face], FacePipeline.detect(img))
+        stats = DetectorStats.get()
+        self.assertEqual((1, 0, 0.0), tuple(stats["opencv"].values()))
+        self.assertEqual((1, 1, 1.0), tuple(stats["mtcnn"].values()))
+
+    @override_settings(DETECTOR_CASCADE=False)
+    def test_cascade_can_be_disabled(self):
+        img = np.zeros((160, 160, 3), dtype=np.uint8)
+        with patch("api.pipeline.FacePipeline.detect_mtcnn", return_value=[]):
+            self.assertEqual([], FacePipeline.detect(img))
+        self.assertEqual(0, DetectorStats.get()["opencv"]["runs"])
+
+    def test_detection_runs_on_bounded_image(self):
+        img = cv2.imread(
+            os.path.join(settings.BASE_DIR, "database/Elon Musk/Elon3.jpg")
+        )
+        large = cv2.resize(img, None, fx=3, fy=3)
+        with patch("api.pipeline.FacePipeline.detect_mtcnn") as mtcnn:
+            faces = FacePipeline.detect(large)
+        mtcnn.assert_not_called()
+        x, y, w, h = faces[0].region
+        self.assertTrue(600 < x + w / 2 < 990 and 240 < y + h / 2 < 600)
+        self.assertEqual((h, w), faces[0].crop.shape[:2])
+
+    @override_settings(DETECTION_MAX_SIDE=100)
+    def test_mtcnn_boxes_are_mapped_back(self):
+        img = np.zeros((400, 300, 3), dtype=np.uint8)
+        detector = MagicMock()
+        detector.detect_faces.return_value = [
+            {
+                "box": [-5, 10, 30, 40],
+                "keypoints": {"left_eye": (10, 20), "right_eye": (20, 20)},
+            }
+        ]
+        with patch("api.pipeline.FacePipeline.detector", return_value=detector):
+            faces = FacePipeline.detect_mtcnn(img)
+        self.assertEqual((100, 75, 3), detector.detect_faces.call_args[0][0].shape)
+        self.assertEqual([0, 40, 120, 160], faces[0].region)
+        self.assertEqual((160, 120, 3), faces[0].crop.shape)
+
+    @override_settings(DETECTION_MAX_SIDE=100)
+    def test_max_side_overrides_the_detection_bound(self):
+        img = np.zeros((400, 300, 3), dtype=np.uint8)
+        detector = MagicMock()
+        detector.detect_faces.return_value = []
+        with patch("api.pipeline.FacePipeline.detector", return_value=detector):
+            FacePipeline.detect(img, max_side=4096)
+        self.assertEqual((400, 300, 3), detector.detect_faces.call_args[0][0].shape)
+
+
+class DecodeTest(TestCase):
+    def jpeg(self, width: int, height: int) -> bytes:
+        img = np.random.default_rng(0).integers(0, 255, (height, width, 3))
+        return cv2.imencode(".jpg", img.astype(np.uint8))[1].tobytes()
+
+    @override_settings(DECODE_MIN_SIDE=1000)
+    def test_large_jpegs_are_decoded_reduced(self):
+        self.assertEqual((750, 1000, 3), decode_image(self.jpeg(4000, 3000)).shape)
+        self.assertEqual((600, 800, 3), decode_image(self.jpeg(800, 600)).shape)
+
+    @override_settings(DECODE_MIN_SIDE=100)
+    def test_other_formats_are_decoded_whole(self):
+        data = cv2.imencode(".png", np.zeros((300, 900, 3), dtype=np.uint8))[1]
+        self.assertEqual((300, 900, 3), decode_image(data.tobytes()).shape)
+
+
+@override_settings(EMBEDDER_BACKEND="api.embedders.StubEmbedder")
+class EmbedderTest(TestCase):
+    def setUp(self):
+        FacePipeline.reset()
+
+    def tearDown(self):
+        FacePipeline.reset()
+
+    def test_backend_is_selected_in_settings(self):
+        self.assertIsInstance(FacePipeline.embedder(), StubEmbedder)
+
+    def test_stub_embeddings_are_deterministic(self):
+        crops = [np.full((50, 40, 3), i, dtype=np.uint8) for i in range(3)]
+        first = FacePipeline.embed([Face(crop, [0, 0, 40, 50]) for crop in crops])
+        second = FacePipeline.embed([Face(crop, [0, 0, 40, 50]) for crop in crops])
+        for a, b in zip(first, second):
+            self.assertEqual((512,), a.embedding.shape)
+            np.testing.assert_array_equal(a.embedding, b.embedding)
+        self.assertFalse(np.allclose(first[0].embedding, first[1].embedding))
+
+    @skipUnless(find_spec("onnxruntime"), "onnxruntime is not installed")
+    def test_onnx_backend_feeds_channels_first_models(self):
+        session = MagicMock()
+        session.get_inputs.return_value = [
+            MagicMock(shape=["batch", 3, 112, 112]),
+        ]
+        session.get_inputs.return_value[0].name = "input"
+        session.run.return_value = [np.ones((2, 512), dtype=np.float32)]
+        with patch("onnxruntime.InferenceSession", return_value=session):
+            embedder = ONNXEmbedder("arcface.onnx")
+        batch = np.zeros((2, 112, 112, 3), dtype=np.float32)
+        self.assertEqual((2, 512), embedder.embed(batch).shape)
+        fed = session.run.call_args[0][1]["input"]
+        self.assertEqual((2, 3, 112, 112), fed.shape)
+        self.assertEqual((112, 112), embedder.input_shape)
+
+    @skipUnless(find_spec("onnxruntime"), "onnxruntime is not installed")
+    @override_settings(
+        EMBEDDER_ONNX_RGB=True, EMBEDDER_ONNX_MEAN=127.5, EMBEDDER_ONNX_STD=128
+    )
+    def test_onnx_backend_normalizes_as_configured(self):
+        session = MagicMock()
+        session.get_inputs.return_value = [MagicMock(shape=["batch", 112, 112, 3])]
+        with patch("onnxruntime.InferenceSession", return_value=session):
+            embedder = ONNXEmbedder("arcface.onnx")
+        batch = np.zeros((1, 112, 112, 3), dtype=np.float32)
+        batch[..., 0] = 1
+        embedder.embed(batch)
+        fed = session.run.call_args[0][1][session.get_inputs.return_value[0].name]
+        np.testing.assert_allclose(
+            [-127.5 / 128, -127.5 / 128, 127.5 / 128], fed[0, 0, 0]
+        )
+
+    def test_onnx_name_follows_the_model_file(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        model = os.path.join(folder, "arcface.onnx")
+        with open(model, "wb") as f:
+            f.write(b"weights")
+        with self.settings(EMBEDDER_ONNX_MODEL=model):
+            name = ONNXEmbedder.name
+            self.assertNotEqual(DeepFaceEmbedder.name, name)
+            with self.settings(EMBEDDER_ONNX_RGB=True):
+                self.assertNotEqual(name, ONNXEmbedder.name)
+            with open(model, "wb") as f:
+                f.write(b"other weights")
+            self.assertNotEqual(name, ONNXEmbedder.name)
+
+
+class InferencePoolTest(TestCase):
+    def tearDown(self):
+        InferencePool.reset()
+        inference.init_error = None
+
+    @override_settings(
+        INFERENCE_PROCESSES=None,
+        INFERENCE_INTRA_OP_THREADS=2,
+        INFERENCE_WEB_WORKERS=4,
+        INFERENCE_TIMEOUT=5,
+    )
+    def test_cores_are_shared_between_web_workers(self):
+        InferencePool.reset()
+        with patch("api.inference.os.cpu_count", return_value=32), patch(
+            "api.inference.multiprocessing.get_context"
+        ) as context:
+            pool = InferencePool.get()
+            pool.process(np.zeros((8, 8, 3), dtype=np.uint8))
+        self.assertEqual(4, context.return_value.Pool.call_args[0][0])
+        pool.pool.apply_async.return_value.get.assert_called_once_with(5)
+
+    def test_failed_worker_start_is_raised_from_tasks(self):
+        with patch(
+            "api.pipeline.FacePipeline.warm_up", side_effect=OSError("no weights")
+        ), patch("api.inference.set_threads"):
+            inference.init_worker(1, 1)
+        with self.assertRaisesRegex(RuntimeError, "no weights"):
+            inference.call(inference.ping)
+
+
+class ReadyViewTest(TestCase):
+    def tearDown(self):
+        apps.get_app_config("api").warmed_up.set()
+
+    def test_not_ready_before_warm_up(self):
+        apps.get_app_config("api").warmed_up.clear()
+        response = self.client.get(reverse("ready"))
+        self.assertEqual(503, response.status_code)
+        self.assertFalse(response.data["ready"])
+
+    def test_ready_after_warm_up(self):
+        apps.get_app_config("api").warmed_up.set()
+        response = self.client.get(reverse("ready"))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.data["ready"])
+
+    @override_settings(PRELOAD_MODELS=False)
+    def test_warm_up_is_opt_in(self):
+        config = apps.get_app_config("api")
+        config.warmed_up.clear()
+        with patch.object(config, "start_warm_up") as start:
+            config.ready()
+        start.assert_not_called()
+        self.assertTrue(config.warmed_up.is_set())
+
+    @override_settings(PRELOAD_MODELS=True)
+    def test_first_request_of_each_process_warms_up(self):
+        config = apps.get_app_config("api")
+        self.addCleanup(vars(config).pop, "warm_up_pid", None)
+        self.addCleanup(request_started.disconnect, dispatch_uid="api-warm-up")
+        with patch("api.apps.threading.Thread") as thread:
+            config.ready()
+            thread.assert_not_called()
+            self.client.get(reverse("ready"))
+            self.client.get(reverse("ready"))
+            self.assertEqual(1, thread.call_count)
+            with patch("api.apps.os.getpid", return_value=-1):
+                self.client.get(reverse("ready"))
+        self.assertEqual(2, thread.call_count)
+
+
+@override_settings(INFERENCE_PROCESSES=0)
+class GroupRecognitionTest(APITestCase):
+    url = reverse("group-recognition")
+
+    def setUp(self):
+        InferencePool.reset()
+        self.client.force_authenticate(
+            User.objects.create_user(email="foo@bar.com", password="test_test_test124")
+        )
+        embeddings = random_gallery(3)
+        self.faces = [Face(None, [0, 0, 10, 10], embedding) for embedding in embeddings]
+        self.students = [
+            Students.objects.create(
+                first_name=first_name,
+                last_name=last_name,
+                email=f"{first_name}@mail.com",
+                year=1,
+                verified=True,
+                field_of_study="CS",
+            )
+            for first_name, last_name in (("Bill", "Gates"), ("Elon", "Musk"))
+        ]
+        self.index = EmbeddingIndex(
+            GalleryRows.from_identities(
+                ["/db/Bill Gates/1.jpg", "/db/Elon Musk/1.jpg", "/db/Jack Ma/1.jpg"],
+                [self.students[0].id, self.students[1].id, None],
+            ),
+            embeddings,
+        )
+        for student in self.students:
+            Attendance.objects.create(student=student, subject="Math")
+
+    def post(self):
+        upload = jpeg_upload("class.jpg")
+        with patch(
+            "api.pipeline.FacePipeline.process", return_value=self.faces
+        ) as self.process, patch(
+            "api.views.EmbeddingIndex.get", return_value=self.index
+        ):
+            return self.client.post(self.url, {"image": upload}, format="multipart")
+
+    @override_settings(GROUP_DETECTION_MAX_SIDE=4096)
+    def test_group_photo_is_detected_at_full_size(self):
+        self.post()
+        self.assertEqual(4096, self.process.call_args[0][1])
+
+    def test_marks_every_recognized_student(self):
+        response = self.post()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, response.data["faces"])
+        self.assertEqual(2, len(response.data["results"]))
+        self.assertEqual(2, Attendance.objects.filter(recognition=True).count())
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(2, outbox.drain())
+        self.assertEqual(2, len(mail.outbox))
+        self.assertEqual(
+            set(Attendance.objects.values_list("id", flat=True)),
+            {
+                tokens.unsign(message.body.split()[-1], settings.SET_ATTENDANCE)
+                for message in mail.outbox
+            },
+        )
+
+    def test_recognized_attendances_are_not_emailed_again(self):
+        Attendance.objects.filter(student=self.students[0]).update(recognition=True)
+        self.post()
+        self.assertEqual(1, outbox.drain())
+        self.assertEqual([self.students[1].email], mail.outbox[0].to)
+
+
+@override_settings(
+    RECOGNITION_QUEUE_BACKEND="api.jobs.LocalQueue",
+    RECOGNITION_WORKERS=0,
+    INFERENCE_PROCESSES=0,
+)
+class RecognitionJobTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        JobQueueHandler.reset()
+        InferencePool.reset()
+        self.client.force_authenticate(
+            User.objects.create_user(email="foo@bar.com", password="test_test_test124")
+        )
+
+    def tearDown(self):
+        JobQueueHandler.reset()
+
+    def test_async_recognition_is_queued_and_polled(self):
+        upload = jpeg_upload("kiosk.jpg")
+        response = self.client.post(
+            reverse("New image") + "?async=true", {"image": upload}, format="multipart"
+        )
+        self.assertEqual(202, response.status_code)
+        url = reverse("recognition-job", args=[response.data["job"]])
+        self.assertEqual(202, self.client.get(url).status_code)
+
+        job_queue = JobQueueHandler.get()
+        with patch("api.pipeline.FacePipeline.process", return_value=[]):
+            process(job_queue, *job_queue.dequeue(timeout=0))
+        response = self.client.get(url)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual({"error": "Face could not be detected"}, response.data)
+
+    def test_unknown_job(self):
+        response = self.client.get(reverse("recognition-job", args=["missing"]))
+        self.assertEqual(404, response.status_code)
+
+
+class UploadTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(
+            User.objects.create_user(email="foo@bar.com", password="test_test_test124")
+        )
+
+    def test_undecodable_upload_is_rejected(self):
+        upload = SimpleUploadedFile("kiosk.jpg", b"jpeg", content_type="image/jpeg")
+        response = self.client.post(
+            reverse("New image"), {"image": upload}, format="multipart"
+        )
+        self.assertEqual(400, response.status_code)
+
+    @override_settings(INFERENCE_PROCESSES=0)
+    def test_upload_is_not_written_to_media(self):
+        InferencePool.reset()
+        with tempfile.TemporaryDirectory() as media, override_settings(
+            MEDIA_ROOT=media + "/"
+        ), patch("api.pipeline.FacePipeline.process", return_value=[]) as process:
+            response = self.client.post(
+                reverse("New image"), {"image": jpeg_upload()}, format="multipart"
+            )
+            self.assertEqual([], os.listdir(media))
+        self.assertEqual(400, response.status_code)
+        self.assertEqual((8, 8, 3), process.call_args[0][0].shape)
+        InferencePool.reset()
+
+
+@override_settings(INFERENCE_PROCESSES=0)
+class RecognitionCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        InferencePool.reset()
+        self.client.force_authenticate(
+            User.objects.create_user(email="foo@bar.com", password="test_test_test124")
+        )
+
+    def tearDown(self):
+        InferencePool.reset()
+
+    def post(self):
+        return self.client.post(
+            reverse("New image"), {"image": jpeg_upload()}, format="multipart"
+        )
+
+    def test_resent_frame_is_served_from_cache(self):
+        with patch("api.pipeline.FacePipeline.process", return_value=[]) as process:
+            first = self.post()
+            second = self.post()
+        self.assertEqual(1, process.call_count)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.status_code, second.status_code)
+
+    def test_gallery_change_invalidates_cache(self):
+        with patch("api.pipeline.FacePipeline.process", return_value=[]) as process:
+            self.post()
+            bump_gallery_version()
+            self.post()
+        self.assertEqual(2, process.call_count)
+
+    @override_settings(RECOGNITION_CACHE="perceptual")
+    def test_perceptual_mode_matches_near_identical_frames(self):
+        img = np.zeros((64, 64, 3), dtype=np.uint8)
+        img[16:48, 16:48] = 200
+        noisy = img.copy()
+        noisy[0, 0] = 3
+        self.assertNotEqual(img.tobytes(), noisy.tobytes())
+        self.assertEqual(RecognitionCache.digest(img), RecognitionCache.digest(noisy))
+
+    @override_settings(RECOGNITION_CACHE=None)
+    def test_disabled_cache(self):
+        with patch("api.pipeline.FacePipeline.process", return_value=[]) as process:
+            self.post()
+            self.post()
+        self.assertEqual(2, process.call_count)
+
+
+@override_settings(INFERENCE_PROCESSES=0)
+class RebuildTest(TestCase):
+    def setUp(self):
+        InferencePool.reset()
+        self.ref_root = tempfile.mkdtemp()
+        for name in ("Bill Gates", "Elon Musk"):
+            os.mkdir(os.path.join(self.ref_root, name))
+            for i in range(2):
+                img = np.full((8, 8, 3), len(name) * 10 + i, dtype=np.uint8)
+                cv2.imwrite(os.path.join(self.ref_root, name, f"{i}.png"), img)
+
+    def tearDown(self):
+        InferencePool.reset()
+        shutil.rmtree(self.ref_root)
+
+    @staticmethod
+    def process(img, max_side=None):
+        rng = np.random.default_rng(int(img[0, 0, 0]))
+        return [Face(img, [0, 0, 8, 8], rng.standard_normal(512).astype(np.float32))]
+
+    def rebuild(self):
+        with patch(
+            "api.pipeline.FacePipeline.process", side_effect=self.process
+        ) as mock:
+            embedded = build_representations(self.ref_root)
+        return embedded, mock.call_count
+
+    def test_unchanged_images_are_not_embedded_again(self):
+        self.assertEqual((4, 4), self.rebuild())
+        self.assertEqual((0, 0), self.rebuild())
+        self.assertEqual(4, len(GalleryStore(self.ref_root).load()[0]))
+
+    def test_modified_image_is_embedded_again(self):
+        self.rebuild()
+        identity = os.path.join(self.ref_root, "Elon Musk", "1.png")
+        cv2.imwrite(identity, np.full((8, 8, 3), 7, dtype=np.uint8))
+        self.assertEqual((1, 1), self.rebuild())
+        index = EmbeddingIndex.load(GalleryStore(self.ref_root))
+        embedding = np.random.default_rng(7).standard_normal(512)
+        self.assertEqual(identity, index.search(embedding)[0][0])
+
+    def test_embedder_change_rebuilds_gallery(self):
+        self.rebuild()
+        store = GalleryStore(self.ref_root)
+        self.assertEqual("ArcFace", store.sidecar()["model"])
+        with self.settings(EMBEDDER_BACKEND="api.embedders.StubEmbedder"), patch(
+            "api.pipeline.FacePipeline.process", side_effect=self.process
+        ) as mock:
+            self.assertEqual("stub", store.sidecar()["model"])
+            self.assertEqual(4, len(store.load()[0]))
+        self.assertEqual(4, mock.call_count)
+
+
+class DuplicateRemoverTest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        for i in range(3):
+            img = rng.integers(0, 255, (16, 16, 3), dtype=np.uint8)
+            cv2.imwrite(os.path.join(self.folder, f"{i}.png"), img)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_bk_tree_search_matches_linear_scan(self):
+        rng = np.random.default_rng(0)
+        hashes = [int(value) for value in rng.integers(0, 2**32, 200)]
+        tree = BKTree()
+        for i, value in enumerate(hashes):
+            tree.add(value, i)
+        for radius in (0, 4, 10):
+            expected = sorted(
+                (BKTree.distance(hashes[0], value), i)
+                for i, value in enumerate(hashes)
+                if BKTree.distance(hashes[0], value) <= radius
+            )
+            self.assertEqual(expected, tree.search(hashes[0], radius))
+
+    def test_add_removes_duplicate_and_keeps_new_image(self):
+        duplicate = os.path.join(self.folder, "copy.png")
+        shutil.copy(os.path.join(self.folder, "0.png"), duplicate)
+        self.assertEqual([duplicate], DuplicateRemover(self.folder).add(duplicate))
+        self.assertFalse(os.path.exists(duplicate))
+
+        other = os.path.join(self.folder, "3.png")
+        cv2.imwrite(other, np.full((16, 16, 3), 255, dtype=np.uint8))
+        self.assertEqual([], DuplicateRemover(self.folder).add(other))
+        self.assertTrue(os.path.exists(other))
+
+    def test_add_checks_the_hash_map_without_listing_the_folder(self):
+        DuplicateRemover(self.folder).find_duplicates()
+        replacement = os.path.join(self.folder, "new.png")
+        shutil.copy(os.path.join(self.folder, "1.png"), replacement)
+        os.remove(os.path.join(self.folder, "1.png"))
+        duplicate = os.path.join(self.folder, "copy.png")
+        shutil.copy(os.path.join(self.folder, "2.png"), duplicate)
+        with patch("api.utils.os.scandir") as scandir:
+            self.assertEqual([], DuplicateRemover(self.folder).add(replacement))
+            self.assertEqual([duplicate], DuplicateRemover(self.folder).add(duplicate))
+        scandir.assert_not_called()
+        self.assertTrue(os.path.exists(replacement))
+        self.assertFalse(os.path.exists(duplicate))
+        self.assertEqual(
+            ["0.png", "2.png", "new.png"],
+            sorted(DuplicateRemover(self.folder).images),
+        )
+
+    def test_add_removes_unreadable_image(self):
+        broken = os.path.join(self.folder, "broken.png")
+        with open(broken, "wb") as f:
+            f.write(b"png")
+        self.assertEqual([broken], DuplicateRemover(self.folder).add(broken))
+        self.assertFalse(os.path.exists(broken))
+
+    def test_only_new_images_are_hashed(self):
+        remover = DuplicateRemover(self.folder)
+        self.assertEqual([], remover.find_duplicates())
+        shutil.copy(
+            os.path.join(self.folder, "1.png"), os.path.join(self.folder, "copy.png")
+        )
+        with patch.object(DuplicateRemover, "hash", wraps=remover.hash) as mock:
+            removed = DuplicateRemover(self.folder).find_duplicates()
+        self.assertEqual(1, mock.call_count)
+        self.assertEqual(1, len(removed))
+        self.assertEqual(3, len(os.listdir(self.folder)) - 1)
+
+    def test_find_similar(self):
+        similar = DuplicateRemover(self.folder).find_similar(
+            os.path.join(self.folder, "2.png")
+        )
+        self.assertEqual(["2.png"], similar)
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        outbox.enqueue_many(
+            [("Subject", f"Message {i}", None, [f"{i}@mail.com"]) for i in range(5)]
+        )
+
+    def test_drains_in_batches_over_one_connection(self):
+        with patch("django.core.mail.backends.locmem.EmailBackend.open") as open_:
+            self.assertEqual(3, outbox.drain(batch_size=3))
+            self.assertEqual(2, outbox.drain(batch_size=3))
+            self.assertEqual(0, outbox.drain(batch_size=3))
+        self.assertEqual(2, open_.call_count)
+        self.assertEqual(
+            [f"{i}@mail.com" for i in range(5)], [m.to[0] for m in mail.outbox]
+        )
+        self.assertFalse(OutboxEmail.objects.filter(sent__isnull=True).exists())
+
+    @override_settings(OUTBOX_RETRY_DELAY=0)
+    def test_retries_failed_emails(self):
+        send_messages = mail.backends.locmem.EmailBackend.send_messages
+        calls = []
+
+        def flaky(backend, messages):
+            calls.append(messages[0].to)
+            if len(calls) == 1:
+                raise ConnectionError("Connection reset")
+            return send_messages(backend, messages)
+
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages", flaky
+        ):
+            self.assertEqual(4, outbox.drain())
+            failed = OutboxEmail.objects.get(sent__isnull=True)
+            self.assertEqual((1, "Connection reset"), (failed.attempts, failed.error))
+            self.assertEqual(1, outbox.drain())
+        self.assertEqual(5, len(mail.outbox))
+
+    @override_settings(OUTBOX_RETRY_DELAY=0, OUTBOX_MAX_ATTEMPTS=1)
+    def test_gives_up_after_max_attempts(self):
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=ConnectionError,
+        ):
+            self.assertEqual(0, outbox.drain())
+        self.assertEqual(0, outbox.drain())
+        self.assertEqual(0, len(mail.outbox))
+
+    def test_unreachable_server_counts_as_an_attempt(self):
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.open",
+            side_effect=ConnectionRefusedError("Connection refused"),
+        ):
+            self.assertEqual(0, outbox.drain())
+            call_command("send_outbox", "--once", stdout=StringIO())
+        self.assertEqual(
+            [(1, "Connection refused")] * 5,
+            list(OutboxEmail.objects.values_list("attempts", "error")),
+        )
+
+    def test_failed_reopen_keeps_the_sent_emails(self):
+        send_messages = mail.backends.locmem.EmailBackend.send_messages
+
+        def flaky(backend, messages):
+            if messages[0].to == ["2@mail.com"]:
+                raise ConnectionError("Connection reset")
+            return send_messages(backend, messages)
+
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages", flaky
+        ), patch(
+            "django.core.mail.backends.locmem.EmailBackend.open",
+            side_effect=[None, ConnectionRefusedError("Connection refused")],
+        ):
+            self.assertEqual(2, outbox.drain())
+        self.assertEqual([0, 1], [int(m.to[0].split("@")[0]) for m in mail.outbox])
+        self.assertEqual(
+            [(0, ""), (0, ""), (1, "Connection reset")]
+            + [(1, "Connection refused")] * 2,
+            list(OutboxEmail.objects.order_by("id").values_list("attempts", "error")),
+        )
+        self.assertEqual(2, OutboxEmail.objects.filter(sent__isnull=False).count())
+
+
+class AttendanceBulkTest(APITestCase):
+    url = reverse("attendance")
+
+    def setUp(self):
+        self.client.force_authenticate(
+            User.objects.create_user(email="foo@bar.com", password="test_test_test124")
+        )
+        self.students = Students.objects.bulk_create(
+            [
+                Students(
+                    first_name=f"Student{i}",
+                    last_name="Test",
+                    year=1 + i % 2,
+                    field_of_study="CS",
+                )
+                for i in range(10)
+            ]
+        )
+
+    def test_list_is_created_with_constant_queries(self):
+        data = [{"student": s.id, "subject": "Math"} for s in self.students]
+        with self.assertNumQueries(2):
+            response = self.client.post(self.url, data, format="json")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(10, Attendance.objects.count())
+
+    def test_list_rejects_unknown_student(self):
+        data = [
+            {"student": self.students[0].id, "subject": "Math"},
+            {"student": 0, "subject": "Math"},
+        ]
+        response = self.client.post(self.url, data, format="json")
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(Attendance.objects.exists())
+
+    def test_roster_opens_attendance_for_cohort(self):
+        data = {"subject": "Math", "field_of_study": "CS", "year": 2}
+        with self.assertNumQueries(2):
+            response = self.client.post(self.url, data, format="json")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {s.id for s in self.students if s.year == 2},
+            set(Attendance.objects.values_list("student_id", flat=True)),
+        )
+
+
+class ConfirmAttendanceTest(APITestCase):
+    def setUp(self):
+        student = Students.objects.create(
+            first_name="Bill", last_name="Gates", year=1, field_of_study="CS"
+        )
+        self.attendance = Attendance.objects.create(student=student, subject="Math")
+        self.token = tokens.sign(self.attendance.id, settings.SET_ATTENDANCE)
+
+    def confirm(self, token):
+        return self.client.post(
+            reverse("confirm-attendance", args=[token]), {}, format="json"
+        )
+
+    def test_confirms_with_a_single_query(self):
+        with self.assertNumQueries(1):
+            response = self.confirm(self.token)
+        self.assertEqual(200, response.status_code)
+        self.attendance.refresh_from_db()
+        self.assertTrue(self.attendance.confirmed)
+        self.assertEqual(400, self.confirm(self.token).status_code)
+
+    def test_rejects_forged_and_expired_tokens(self):
+        forged = tokens.sign(self.attendance.id, settings.FORGOT_PASSWORD_PREFIX)
+        self.assertEqual(400, self.confirm(forged).status_code)
+        with override_settings(TOKEN_MAX_AGE=-1):
+            self.assertEqual(400, self.confirm(self.token).status_code)
+        self.assertFalse(Attendance.objects.get().confirmed)
+
+    def test_rejects_revoked_token(self):
+        tokens.revoke(self.token)
+        self.assertEqual(400, self.confirm(self.token).status_code)
+        self.assertFalse(Attendance.objects.get().confirmed)
+
+
+class RecognitionAttendanceTest(APITestCase):
+    url = reverse("New image")
+
+    def setUp(self):
+        cache.clear()
+        InferencePool.reset()
+        self.ref_root = tempfile.mkdtemp() + "/"
+        self.client.force_authenticate(
+            User.objects.create_user(email="foo@bar.com", password="test_test_test124")
+        )
+        self.student = Students.objects.create(
+            first_name="Mary Ann",
+            last_name="Smith",
+            email="mary@mail.com",
+            year=1,
+            verified=True,
+            field_of_study="CS",
+        )
+        self.attendance = Attendance.objects.create(
+            student=self.student, subject="Math"
+        )
+        self.embedding = random_gallery(1)[0]
+        os.mkdir(self.ref_root + "Mary Ann Smith")
+        with override_settings(REF_ROOT=self.ref_root):
+            GalleryStore().write(
+                [self.ref_root + "Mary Ann Smith/0.jpg"], [self.embedding]
+            )
+        EmbeddingIndex.reset()
+
+    def tearDown(self):
+        EmbeddingIndex.reset()
+        shutil.rmtree(self.ref_root)
+
+    def test_marks_attendance_of_student_with_spaces_in_name(self):
+        face = Face(np.zeros((8, 8, 3), dtype=np.uint8), [0, 0, 8, 8], self.embedding)
+        with override_settings(REF_ROOT=self.ref_root, INFERENCE_PROCESSES=0), patch(
+            "api.pipeline.FacePipeline.process", return_value=[face]
+        ):
+            response = self.client.post(
+                self.url, {"image": jpeg_upload()}, format="multipart"
+            )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.student.id, response.data["detected"]["id"])
+        self.attendance.refresh_from_db()
+        self.assertTrue(self.attendance.recognition)
+        self.assertEqual(["mary@mail.com"], OutboxEmail.objects.get().recipients)
+
+    def test_enrolls_the_upload_as_sent(self):
+        embedding = self.embedding + 0.7 * random_gallery(1, seed=3)[0]
+        face = Face(None, [0, 0, 8, 8], embedding / np.linalg.norm(embedding))
+        img = np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+        _, data = cv2.imencode(".jpg", img)
+        upload = SimpleUploadedFile("large.jpg", data.tobytes())
+        with override_settings(
+            REF_ROOT=self.ref_root, INFERENCE_PROCESSES=0, DECODE_MIN_SIDE=16
+        ), patch("api.pipeline.FacePipeline.process", return_value=[face]) as process:
+            response = self.client.post(self.url, {"image": upload}, format="multipart")
+        self.assertEqual((16, 16, 3), process.call_args[0][0].shape)
+        self.assertEqual(200, response.status_code)
+        (enrolled,) = [
+            name
+            for name in os.listdir(self.ref_root + "Mary Ann Smith")
+            if name.endswith(".jpg")
+        ]
+        upload.seek(0)
+        with open(self.ref_root + "Mary Ann Smith/" + enrolled, "rb") as f:
+            self.assertEqual(upload.read(), f.read())
+
+    def enroll(self, name, data):
+        embedding = self.embedding + 0.7 * random_gallery(1, seed=3)[0]
+        face = Face(None, [0, 0, 8, 8], embedding / np.linalg.norm(embedding))
+        with override_settings(REF_ROOT=self.ref_root, INFERENCE_PROCESSES=0), patch(
+            "api.pipeline.FacePipeline.process", return_value=[face]
+        ):
+            response = self.client.post(
+                self.url, {"image": SimpleUploadedFile(name, data)}, format="multipart"
+            )
+        self.assertEqual(200, response.status_code)
+        self.attendance.refresh_from_db()
+        self.assertTrue(self.attendance.recognition)
+        (enrolled,) = [
+            name
+            for name in os.listdir(self.ref_root + "Mary Ann Smith")
+            if not name.startswith(".")
+        ]
+        self.assertIn(
+            self.ref_root + "Mary Ann Smith/" + enrolled,
+            GalleryStore(self.ref_root).load()[0],
+        )
+        return self.ref_root + "Mary Ann Smith/" + enrolled
+
+    def test_enrolls_other_formats_under_their_extension(self):
+        img = np.random.default_rng(0).integers(0, 255, (16, 16, 3), dtype=np.uint8)
+        data = cv2.imencode(".webp", img)[1].tobytes()
+        enrolled = self.enroll("frame", data)
+        self.assertTrue(enrolled.endswith(".webp"))
+        with open(enrolled, "rb") as f:
+            self.assertEqual(data, f.read())
+
+    def test_enrolls_unindexed_formats_as_png(self):
+        img = np.random.default_rng(0).integers(0, 255, (16, 16, 3), dtype=np.uint8)
+        enrolled = self.enroll("frame.ppm", cv2.imencode(".ppm", img)[1].tobytes())
+        self.assertTrue(enrolled.endswith(".png"))
+        np.testing.assert_array_equal(img, cv2.imread(enrolled))
+
+
+@override_settings(INFERENCE_PROCESSES=0, RECOGNITION_CACHE=None)
+class BatchRecognitionTest(APITestCase):
+    url = reverse("batch-recognition")
+
+    def setUp(self):
+        InferencePool.reset()
+        self.ref_root = tempfile.mkdtemp() + "/"
+        self.client.force_authenticate(
+            User.objects.create_user(email="foo@bar.com", password="test_test_test124")
+        )
+        self.student = Students.objects.create(
+            first_name="Bill",
+            last_name="Gates",
+            email="bill@mail.com",
+            year=1,
+            verified=True,
+            field_of_study="CS",
+        )
+        Attendance.objects.create(student=self.student, subject="Math")
+        self.embedding = random_gallery(1)[0]
+        os.mkdir(self.ref_root + "Bill Gates")
+        with override_settings(REF_ROOT=self.ref_root):
+            GalleryStore().write(
+                [self.ref_root + "Bill Gates/0.jpg"],
+                [self.embedding],
+                [self.student.id],
+            )
+        EmbeddingIndex.reset()
+
+    def tearDown(self):
+        EmbeddingIndex.reset()
+        shutil.rmtree(self.ref_root)
+
+    def test_reports_every_image_in_order(self):
+        face = Face(np.zeros((8, 8, 3), dtype=np.uint8), [0, 0, 8, 8])
+        embedded = Face(face.crop, face.region, self.embedding)
+        uploads = [jpeg_upload("empty.jpg"), jpeg_upload("bill.jpg")]
+        with override_settings(REF_ROOT=self.ref_root), patch(
+            "api.pipeline.FacePipeline.detect", side_effect=[[], [face]]
+        ), patch("api.pipeline.FacePipeline.embed", return_value=[embedded]) as embed:
+            response = self.client.post(
+                self.url, {"images": uploads}, format="multipart"
+            )
+        self.assertEqual(200, response.status_code)
+        missing, detected = response.data["results"]
+        self.assertEqual({"error": "Face could not be detected"}, missing)
+        self.assertEqual(self.student.id, detected["detected"]["id"])
+        embed.assert_called_once_with([face])
+        self.assertTrue(Attendance.objects.get().recognition)
+
+    @override_settings(RECOGNITION_BATCH_MAX_IMAGES=2)
+    def test_oversized_batch_is_rejected(self):
+        uploads = [jpeg_upload(f"{i}.jpg") for i in range(3)]
+        with patch("api.pipeline.FacePipeline.detect") as detect:
+            response = self.client.post(
+                self.url, {"images": uploads}, format="multipart"
+            )
+        self.assertEqual(400, response.status_code)
+        detect.assert_not_called()
+
+
+class BenchmarkTest(TestCase):
+    def test_reports_every_stage(self):
+        report = benchmark.run(size=100, requests=5)
+        self.assertEqual(100, report["gallery"])
+        self.assertEqual(set(benchmark.STAGES), set(report["stages"]))
+        for stage in report["stages"].values():
+            self.assertEqual(5, stage["samples"])
+            self.assertLessEqual(stage["p50_ms"], stage["p99_ms"])
+        self.assertFalse(Students.objects.exists())
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    def test_fake_pipeline_is_deterministic(self):
+        img = decode_image(benchmark.frames(1)[0])
+        first = benchmark.FakePipeline.embed(benchmark.FakePipeline.detect(img))
+        second = benchmark.FakePipeline.embed(benchmark.FakePipeline.detect(img))
+        np.testing.assert_array_equal(first[0].embedding, second[0].embedding)
+
+    def test_fake_pipeline_embeds_preprocessed_crops(self):
+        img = decode_image(benchmark.frames(1)[0])
+        faces = benchmark.FakePipeline.detect(img)
+        pixels = preprocess(faces[0].crop, StubEmbedder.input_shape)
+        with patch("api.pipeline.preprocess", wraps=preprocess) as wrapped:
+            benchmark.FakePipeline.embed(faces)
+        wrapped.assert_called_once()
+        np.testing.assert_array_equal(
+            StubEmbedder().embed(pixels[None])[0], faces[0].embedding
+        )
@@ -1,9 +1,20 @@
 from django.urls import path
-from .views import RecognitionView, ModelView, AttendanceView, ConfirmAttendance
+from .views import (
+    RecognitionView,
+    RecognitionJobView,
+    BatchRecognitionView,
+    GroupRecognitionView,
+    ModelView,
+    AttendanceView,
+    ConfirmAttendance,
+)
 
 urlpatterns = [
     path("recognition/", RecognitionView.as_view(), name="New image"),
+    path("recognition/jobs/<str:job_id>", RecognitionJobView.as_view(), name="recognition-job"),
+    path("recognition/batch/", BatchRecognitionView.as_view(), name="batch-recognition"),
+    path("recognition/group/", GroupRecognitionView.as_view(), name="group-recognition"),
     path("model/", ModelView.as_view(), name="Create new model"),
     path("attendance/", AttendanceView.as_view(), name="attendance"),
-    path("confirm-attendance/<str:token>", ConfirmAttendance.as_view())
+    path("confirm-attendance/<str:token>", ConfirmAttendance.as_view(), name="confirm-attendance")
 ]
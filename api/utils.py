@@ -1,16 +1,25 @@
+import cv2
+import hashlib
 import imagehash
+import io
+import json
+import logging
 import os
 import numpy as np
 
-from uuid import uuid4
 from PIL import Image
 
 from django.conf import settings
-from django.core.files.storage import default_storage
 from django.core.cache import cache
-from django.core.mail import send_mail
 
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.serializers import ValidationError
+
+from . import outbox, tokens
+from .pipeline import decode_flag
+
+logger = logging.getLogger(__name__)
 
 
 class TokenHandler:
@@ -18,83 +27,238 @@ class TokenHandler:
     instance = None
     model_instance = None
 
-    def __init__(self, instance=None, model_instance=None, token=None):
-        self.__token = str(uuid4()) if token is None else token
+    def __init__(self, instance=None, model_instance=None):
         self.instance = instance
         self.model_instance = model_instance
-
-    def create_token(self) -> None:
-        cache.set(self.instance + self.__token, self.model_instance.id, timeout=1000 * 60 * 60 * 24 * 3)
-
-    def get_token(self, instance, token):
-        return cache.get(instance + token)
-
-    def retrive_token(self):
-        return self.__token
+        self.__token = tokens.sign(model_instance.id, instance)
 
     def email_token(self, model_instance):
-        send_mail(
+        outbox.enqueue(
             subject="Confirm your attendance",
             message=f"Here is token to confirm your attendance {self.__token}",
-            from_email=[settings.EMAIL_HOST_USER, ],
-            recipient_list=[
+            recipients=[
                 model_instance.email,
+            ],
+        )
+
+    @staticmethod
+    def email_tokens(instance, attendances) -> None:
+        outbox.enqueue_many(
+            [
+                (
+                    "Confirm your attendance",
+                    "Here is token to confirm your attendance "
+                    f"{tokens.sign(attendance.id, instance)}",
+                    settings.EMAIL_HOST_USER,
+                    [attendance.student.email],
+                )
+                for attendance in attendances
             ]
         )
 
 
+class BKTree(object):
+    """
+    Burkhard-Keller tree over integer hashes with Hamming distance, a radius
+    query only visits children whose edge distance can still be in range
+    """
+
+    def __init__(self):
+        self.root = None
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
+
+    def add(self, value: int, item) -> None:
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = self.distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (value, [item], {})
+                return
+            node = node[2][distance]
+
+    def search(self, value: int, radius: int) -> list:
+        """
+        (distance, item) pairs within radius of value
+        """
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = self.distance(value, node[0])
+            if distance <= radius:
+                found.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    nodes.append(child)
+        return sorted(found)
+
+
 class DuplicateRemover:
+    """
+    Finds duplicate and similar images of a student folder through a
+    persistent average hash index. New images are checked against a hash to
+    names map without listing the folder, the BK-tree is only built for
+    similarity searches
+    """
+
+    index_file = ".hashes.json"
+
     def __init__(self, dirname, hash_size=8):
         self.dirname = dirname
         self.hash_size = hash_size
+        self.path = os.path.join(dirname, self.index_file)
+        self.images, self.hashes = self.load()
+
+    def load(self) -> tuple:
+        if not os.path.exists(self.path):
+            return {}, {}
+        with open(self.path) as f:
+            index = json.load(f)
+        if index["hash_size"] != self.hash_size:
+            return {}, {}
+        if "hashes" not in index:
+            return index["images"], self.group(index["images"])
+        return index["images"], index["hashes"]
 
-    def find_duplicates(self):
-        fnames = os.listdir(self.dirname)
+    @staticmethod
+    def group(images: dict) -> dict:
         hashes = {}
+        for image in sorted(images):
+            hashes.setdefault(images[image][0], []).append(image)
+        return hashes
+
+    def save(self) -> None:
+        from .gallery import atomic_write
+
+        with atomic_write(self.path) as f:
+            json.dump(
+                {
+                    "hash_size": self.hash_size,
+                    "images": self.images,
+                    "hashes": self.hashes,
+                },
+                f,
+            )
+
+    def hash(self, location) -> int:
+        with Image.open(location) as img:
+            return int(str(imagehash.average_hash(img, self.hash_size)), 16)
+
+    def sync(self) -> None:
+        """
+        Indexes images that are new or changed since the last sync and forgets
+        removed ones
+        """
+        from .gallery import IMAGE_EXTENSIONS
+
+        current = {}
+        for entry in os.scandir(self.dirname):
+            if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            cached = self.images.get(entry.name)
+            if cached and cached[1:] == [stat.st_mtime_ns, stat.st_size]:
+                current[entry.name] = cached
+            else:
+                current[entry.name] = [
+                    f"{self.hash(entry.path):x}",
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ]
+        changed = current != self.images
+        self.images = current
+        if changed:
+            self.hashes = self.group(current)
+            self.save()
+
+    def tree(self) -> BKTree:
+        tree = BKTree()
+        for image in sorted(self.images):
+            tree.add(int(self.images[image][0], 16), image)
+        return tree
+
+    def forget(self, image: str) -> None:
+        digest = self.images.pop(image)[0]
+        names = self.hashes[digest]
+        names.remove(image)
+        if not names:
+            del self.hashes[digest]
+
+    def remove(self, duplicates: list) -> list:
+        for duplicate in duplicates:
+            os.remove(os.path.join(self.dirname, duplicate))
+            self.forget(duplicate)
+        if duplicates:
+            self.save()
+            logger.info("Removed duplicates %s from %s", duplicates, self.dirname)
+        return [os.path.join(self.dirname, duplicate) for duplicate in duplicates]
+
+    def add(self, location) -> list:
+        """
+        Indexes a newly written image and removes it again when the folder
+        already holds a duplicate of it or it cannot be hashed. The folder is
+        only listed when it has no index yet
+        """
+        image = os.path.basename(location)
+        try:
+            digest = f"{self.hash(location):x}"
+        except Exception as error:
+            logger.warning("Hashing %s failed: %s", location, error)
+            os.remove(location)
+            return [location]
+        if not os.path.exists(self.path):
+            self.sync()
+        for name in list(self.hashes.get(digest, ())):
+            if name == image:
+                continue
+            if os.path.exists(os.path.join(self.dirname, name)):
+                logger.info("Duplicate %s found for image %s", image, name)
+                os.remove(location)
+                return [location]
+            self.forget(name)
+        if image in self.images:
+            self.forget(image)
+        stat = os.stat(location)
+        self.images[image] = [digest, stat.st_mtime_ns, stat.st_size]
+        self.hashes.setdefault(digest, []).append(image)
+        self.save()
+        return []
+
+    def find_duplicates(self) -> list:
+        self.sync()
         duplicates = []
         print("Finding duplicates now")
-        for image in fnames:
-            with Image.open(os.path.join(self.dirname, image)) as img:
-                temp_hash = imagehash.average_hash(img, self.hash_size)
-                if temp_hash in hashes:
-                    print(
-                        "Duplicate {} found for Image {}".format(
-                            image, hashes[temp_hash]
-                        )
-                    )
-                    duplicates.append(image)
-                else:
-                    hashes[temp_hash] = image
-
-        if len(duplicates) != 0:
-            space_saved = 0
-            for duplicate in duplicates:
-                space_saved += os.path.getsize(os.path.join(self.dirname, duplicate))
-
-                os.remove(os.path.join(self.dirname, duplicate))
-            print("All duplicates are deleted")
-        else:
-            print("No Duplicates Found")
-
-    def find_similar(self, location, similarity=80):
-        fnames = os.listdir(self.dirname)
-        threshold = 1 - similarity / 100
-        diff_limit = int(threshold * (self.hash_size ** 2))
+        for names in self.hashes.values():
+            for image in names[1:]:
+                print("Duplicate {} found for Image {}".format(image, names[0]))
+                duplicates.append(image)
+        removed = self.remove(sorted(duplicates))
+        print("All duplicates are deleted" if removed else "No Duplicates Found")
+        return removed
 
-        with Image.open(location) as img:
-            hash1 = imagehash.average_hash(img, self.hash_size).hash
+    def find_similar(self, location, similarity=80) -> list:
+        self.sync()
+        threshold = 1 - similarity / 100
+        diff_limit = int(threshold * (self.hash_size**2))
 
         print("Finding Similar Images to {} Now!\n".format(location))
-        for image in fnames:
-            with Image.open(os.path.join(self.dirname, image)) as img:
-                hash2 = imagehash.average_hash(img, self.hash_size).hash
-
-                if np.count_nonzero(hash1 != hash2) <= diff_limit:
-                    print(
-                        "{} image found {}% similar to {}".format(
-                            image, similarity, location
-                        )
-                    )
+        similar = [
+            image for _, image in self.tree().search(self.hash(location), diff_limit)
+        ]
+        for image in similar:
+            print(
+                "{} image found {}% similar to {}".format(image, similarity, location)
+            )
+        return similar
 
 
 class ResponseHandler(object):
@@ -128,9 +292,99 @@ class ResponseHandler(object):
         return Response(response, status=200)
 
 
+def response_payload(response: Response) -> dict:
+    return {
+        "status": response.status_code,
+        "data": json.loads(JSONRenderer().render(response.data)),
+    }
+
+
+class RecognitionCache(object):
+    """
+    Recognition responses keyed by the decoded frame so resent kiosk frames
+    skip the pipeline, "content" matches identical pixels and "perceptual"
+    also matches frames with the same perceptual hash. The gallery version
+    is part of the key so any gallery change invalidates it
+    """
+
+    @staticmethod
+    def digest(img: np.ndarray) -> str:
+        if settings.RECOGNITION_CACHE == "perceptual":
+            return str(
+                imagehash.phash(Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)))
+            )
+        return hashlib.sha256(img.tobytes()).hexdigest()
+
+    @staticmethod
+    def key(digest: str) -> str:
+        from .gallery import gallery_version
+
+        return f"recognition:{settings.RECOGNITION_CACHE}:{gallery_version()}:{digest}"
+
+    @classmethod
+    def get(cls, digest: str):
+        payload = cache.get(cls.key(digest))
+        if payload is None:
+            return None
+        return Response(payload["data"], status=payload["status"])
+
+    @classmethod
+    def set(cls, digest: str, response: Response) -> None:
+        cache.set(
+            cls.key(digest),
+            response_payload(response),
+            timeout=settings.RECOGNITION_CACHE_TTL,
+        )
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    """
+    Decodes large JPEGs at reduced scale, see pipeline.decode_flag
+    """
+    img = cv2.imdecode(
+        np.frombuffer(data, dtype=np.uint8), decode_flag(io.BytesIO(data))
+    )
+    if img is None:
+        raise ValidationError("Image could not be decoded")
+    return img
+
+
 def upload_image_handler(request):
-    img = request.FILES["image"]
-    img_extension = os.path.splitext(img.name)[-1]
-    img_full = settings.MEDIA_ROOT + str(uuid4()) + img_extension
-    default_storage.save(img_full, img)
-    return img_full
+    data = request.FILES["image"].read()
+    return decode_image(data), data
+
+
+def upload_images_handler(request):
+    uploads = []
+    for img in request.FILES.getlist("images"):
+        data = img.read()
+        uploads.append((decode_image(data), data))
+    return uploads
+
+
+UPLOAD_EXTENSIONS = {
+    "JPEG": ".jpg",
+    "PNG": ".png",
+    "WEBP": ".webp",
+    "BMP": ".bmp",
+    "TIFF": ".tif",
+}
+
+
+def write_upload(stem: str, data: bytes) -> str:
+    """
+    Stores an upload as it was sent, the decoded image may be reduced in
+    scale, under the extension of its format and returns its path. Formats
+    the gallery does not index are stored as PNG
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as header:
+            extension = UPLOAD_EXTENSIONS.get(header.format)
+    except Exception:
+        extension = None
+    if extension is None:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        extension, data = ".png", cv2.imencode(".png", img)[1].tobytes()
+    with open(stem + extension, "wb") as f:
+        f.write(data)
+    return stem + extension
@@ -1,20 +1,34 @@
+from django.apps import apps
 from django.conf import settings
+from django.db import transaction
 
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 
-import pandas as pd
 import numpy as np
 import os
-import shutil
 from os import path
 from uuid import uuid4
-from cv2 import imread, imwrite
-from deepface import DeepFace
 
-from .utils import upload_image_handler, DuplicateRemover, ResponseHandler, TokenHandler
-from .serializer import StudentSerializer, AttendanceSerializer, ConfirmAttendanceSerializer
+from .gallery import EmbeddingIndex, GalleryPolicy, identity_name
+from . import tokens
+from .jobs import JobQueueHandler, encode_image
+from .inference import InferencePool
+from .utils import (
+    upload_image_handler,
+    upload_images_handler,
+    write_upload,
+    DuplicateRemover,
+    RecognitionCache,
+    ResponseHandler,
+    TokenHandler,
+)
+from .serializer import (
+    StudentSerializer,
+    AttendanceSerializer,
+    AttendanceRosterSerializer,
+)
 from .model import Students, Attendance
 
 
@@ -22,63 +36,167 @@ class RecognitionView(APIView):
     permission_classes = (IsAuthenticated,)
 
     def post(self, request, *args, **kwargs) -> Response:
-        shutil.rmtree(settings.MEDIA_ROOT)
-        upload = upload_image_handler(request=request)
-        img = imread(upload)
-        DeepFace.verify(img1_path=upload, img2_path=upload)
-        result = DeepFace.find(
-            img,
-            db_path=settings.REF_ROOT,
-            detector_backend="mtcnn",
-            model_name="ArcFace",
-        )
-        if not result.empty:
-            data = pd.DataFrame(result)
-            imwrite(
-                filename=settings.REF_ROOT
-                         + str(os.path.split(os.path.dirname(data["identity"][0]))[-1])
-                         + "/"
-                         + str(uuid4())
-                         + str(path.splitext(upload)[-1]),
-                img=img,
-            )
+        if request.query_params.get("async") in ("1", "true"):
+            job_id = JobQueueHandler.get().enqueue(encode_image(request.FILES["image"]))
+            return Response({"job": job_id}, status=202)
+        img, data = upload_image_handler(request=request)
+        return self.run(img, data)
 
-            try:
-                student_data = os.path.split(os.path.dirname(data["identity"][0]))[-1]
-                student_data = student_data.split()
-                student = Students.objects.filter(
-                    first_name=student_data[0], last_name=student_data[1]
-                ).first()
-                attendance = Attendance.objects.filter(student=student.id, confirmed=False, recognition=False).first()
-                handler = TokenHandler(token=attendance.token, instance=str(settings.SET_ATTENDANCE),
-                                       model_instance=student)
-                handler.create_token()
-                handler.email_token(model_instance=Students.objects.filter(id=attendance.student.id).first())
-                attendance.recognition = True
-                attendance.save()
-                duplicate = DuplicateRemover(
-                    settings.REF_ROOT + f"{student_data[0]} {student_data[1]}"
-                )
-                duplicate.find_duplicates()
-            except Students.DoesNotExist:
-                return ResponseHandler.get().create_error_response(
-                    "Student doesn't exist in database"
-                )
-            serializer = StudentSerializer(student)
-            if not serializer.data["verified"]:
-                return ResponseHandler.get().create_error_response(
-                    "Student not verified"
+    def run(self, img, data) -> Response:
+        if not settings.RECOGNITION_CACHE:
+            return self.detect_and_recognize(img, data)
+        digest = RecognitionCache.digest(img)
+        response = RecognitionCache.get(digest)
+        if response is None:
+            response = self.detect_and_recognize(img, data)
+            RecognitionCache.set(digest, response)
+        return response
+
+    def detect_and_recognize(self, img, data) -> Response:
+        faces = InferencePool.get().process(img)
+        if not faces:
+            return ResponseHandler.get().create_error_response("Face could not be detected")
+        embedding = faces[0].embedding
+        return self.recognize(data, embedding, EmbeddingIndex.get().search(embedding))
+
+    def recognize(self, data, embedding, matches) -> Response:
+        if matches:
+            identity = matches[0][0]
+            index = EmbeddingIndex.get()
+            student_id = index.student(identity)
+            policy = GalleryPolicy(index=index)
+            policy.hit(identity)
+            if policy.admit(identity_name(identity), embedding):
+                filename = write_upload(
+                    settings.REF_ROOT + identity_name(identity) + "/" + str(uuid4()),
+                    data,
                 )
-            return ResponseHandler.get().create_response(
-                {
-                    "detected": serializer.data,
-                    "avg_cosine": np.average(data.ArcFace_cosine),
-                }
-            )
+                if not DuplicateRemover(path.dirname(filename)).add(filename):
+                    policy.enroll(filename, embedding, student_id)
+            return self.respond(self.mark_attendance(student_id), matches)
         return ResponseHandler.get().create_error_response(
             {"Requested picture does not match any in database"}
         )
 
+    def mark_attendance(self, student_id):
+        """
+        Marks the oldest pending attendance of the student as recognized and
+        emails its token, returns the student
+        """
+        attendance = (
+            Attendance.objects.select_related("student")
+            .filter(student_id=student_id, confirmed=False, recognition=False)
+            .order_by("id")
+            .first()
+        )
+        if attendance is None:
+            return Students.objects.filter(pk=student_id).first()
+        if Attendance.objects.filter(pk=attendance.pk, recognition=False).update(
+            recognition=True
+        ):
+            handler = TokenHandler(instance=str(settings.SET_ATTENDANCE), model_instance=attendance)
+            handler.email_token(model_instance=attendance.student)
+        return attendance.student
+
+    def respond(self, student, matches) -> Response:
+        if student is None:
+            return ResponseHandler.get().create_error_response(
+                "Student doesn't exist in database"
+            )
+        serializer = StudentSerializer(student)
+        if not serializer.data["verified"]:
+            return ResponseHandler.get().create_error_response(
+                "Student not verified"
+            )
+        return ResponseHandler.get().create_response(
+            {
+                "detected": serializer.data,
+                "avg_cosine": np.average([distance for _, distance in matches]),
+            }
+        )
+
+
+class RecognitionJobView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, job_id) -> Response:
+        result = JobQueueHandler.get().result(job_id)
+        if result is None:
+            return Response({"error": "Job does not exist"}, status=404)
+        if result["state"] == "pending":
+            return Response({"state": "pending"}, status=202)
+        return Response(result["data"], status=result["status"])
+
+
+class BatchRecognitionView(RecognitionView):
+    def post(self, request, *args, **kwargs) -> Response:
+        if len(request.FILES.getlist("images")) > settings.RECOGNITION_BATCH_MAX_IMAGES:
+            return ResponseHandler.get().create_error_response(
+                f"At most {settings.RECOGNITION_BATCH_MAX_IMAGES} images per batch"
+            )
+        uploads = upload_images_handler(request=request)
+        pool = InferencePool.get()
+        detected = pool.detect([img for img, _ in uploads])
+        faces = pool.embed([faces[0] for faces in detected if faces])
+        matches = iter(EmbeddingIndex.get().search_many([face.embedding for face in faces]))
+        faces = iter(faces)
+        results = []
+        for (_, data), image_faces in zip(uploads, detected):
+            if not image_faces:
+                results.append({"error": "Face could not be detected"})
+                continue
+            response = self.recognize(data, next(faces).embedding, next(matches))
+            results.append(response.data)
+        return ResponseHandler.get().create_response({"results": results})
+
+
+class GroupRecognitionView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs) -> Response:
+        img, _ = upload_image_handler(request=request)
+        faces = InferencePool.get().process(img, settings.GROUP_DETECTION_MAX_SIDE)
+        if not faces:
+            return ResponseHandler.get().create_error_response("Face could not be detected")
+        index = EmbeddingIndex.get()
+        best = {}
+        for matches in index.search_many([face.embedding for face in faces]):
+            if matches:
+                student = index.student(matches[0][0])
+                if student not in best or matches[0][1] < best[student][0][1]:
+                    best[student] = matches
+        students = Students.objects.filter(verified=True).in_bulk(
+            [student for student in best if student is not None]
+        )
+        attendances = {}
+        with transaction.atomic():
+            pending = (
+                Attendance.objects.select_for_update(of=("self",))
+                .select_related("student")
+                .filter(student_id__in=students, confirmed=False, recognition=False)
+                .order_by("id")
+            )
+            for attendance in pending:
+                attendances.setdefault(attendance.student_id, attendance)
+            attendances = list(attendances.values())
+            Attendance.objects.filter(
+                id__in=[attendance.id for attendance in attendances], recognition=False
+            ).update(recognition=True)
+        TokenHandler.email_tokens(str(settings.SET_ATTENDANCE), attendances)
+        return ResponseHandler.get().create_response(
+            {
+                "faces": len(faces),
+                "results": [
+                    {
+                        "detected": StudentSerializer(students[student]).data,
+                        "avg_cosine": np.average([distance for _, distance in matches]),
+                    }
+                    for student, matches in best.items()
+                    if student in students
+                ],
+            }
+        )
+
 
 class ModelView(APIView):
     permission_classes = (IsAdminUser,)
@@ -110,30 +228,23 @@ class ModelView(APIView):
         )
 
     def put(self, request, *args, **kwargs):
-        if os.path.exists(settings.REF_ROOT + "representations_arcface.pkl"):
-            os.remove(path=settings.REF_ROOT + "representations_arcface.pkl")
-        upload = upload_image_handler(request=request)
-        img = imread(upload)
-        verify = DeepFace.verify(img1_path=upload, img2_path=upload)
-        if verify.get("verified"):
-            imwrite(
-                filename=settings.REF_ROOT
-                         + f"{request.data['name']} {request.data['last_name']}"
-                         + "/"
-                         + str(uuid4())
-                         + str(path.splitext(upload)[-1]),
-                img=img,
-            )
-            test_recog = DeepFace.find(
-                upload,
-                db_path=settings.REF_ROOT,
-                detector_backend="mtcnn",
-                model_name="ArcFace",
+        img, data = upload_image_handler(request=request)
+        faces = InferencePool.get().process(img)
+        if faces:
+            filename = write_upload(
+                settings.REF_ROOT
+                + f"{request.data['name']} {request.data['last_name']}"
+                + "/"
+                + str(uuid4()),
+                data,
             )
-            if not test_recog.empty:
-                student = Students.objects.filter(
-                    first_name=request.data["name"], last_name=request.data["last_name"]
-                ).first()
+            embedding = faces[0].embedding
+            student = Students.objects.filter(
+                first_name=request.data["name"], last_name=request.data["last_name"]
+            ).first()
+            if not DuplicateRemover(path.dirname(filename)).add(filename):
+                GalleryPolicy().enroll(filename, embedding, student and student.id)
+            if EmbeddingIndex.get().search(embedding):
                 serializer = StudentSerializer(instance=student, data=request.data)
                 if serializer.is_valid():
                     serializer.save()
@@ -183,6 +294,13 @@ class AttendanceView(APIView):
                 serializer.save()
                 return ResponseHandler().get().create_success_response("Attendance created!")
             return ResponseHandler.get().create_error_response("There was an error while creating attendance")
+        if "field_of_study" in request.data:
+            serializer = AttendanceRosterSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            attendances = serializer.save()
+            return ResponseHandler.get().create_success_response(
+                f"Attendance created for {len(attendances)} students!"
+            )
         serializer = AttendanceSerializer(data=request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
@@ -192,13 +310,22 @@ class AttendanceView(APIView):
 
 class ConfirmAttendance(APIView):
     def post(self, request, token):
-        handler = TokenHandler(token=token)
-        data = handler.get_token(instance=str(settings.SET_ATTENDANCE), token=token)
-        if not data:
+        attendance = tokens.unsign(token, str(settings.SET_ATTENDANCE))
+        if attendance is None:
             return ResponseHandler.get().create_error_response("Token expired")
-        serializer = ConfirmAttendanceSerializer(instance=Attendance.objects.filter(token=token).first(),
-                                                 data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            serializer.save()
+        confirmed = Attendance.objects.filter(
+            ~tokens.revoked(token), pk=attendance, confirmed=False
+        ).update(confirmed=True)
+        if confirmed:
             return ResponseHandler.get().create_success_response("Attendance confirmed")
         return ResponseHandler.get().create_error_response("There was an error while confirming your attendance")
+
+
+class ReadyView(APIView):
+    permission_classes = (AllowAny,)
+    authentication_classes = ()
+
+    def get(self, request) -> Response:
+        if apps.get_app_config("api").warmed_up.is_set():
+            return Response({"ready": True}, status=200)
+        return Response({"ready": False}, status=503)
@@ -8,11 +8,12 @@ from rest_framework.validators import UniqueValidator, ValidationError
 
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
-from django.core.mail import send_mail
 from django.conf import settings
 
 from uuid import uuid4
 
+from api import outbox
+
 from .models import User
 from .utils import TokenHandler
 
@@ -73,11 +74,10 @@ class RegisterSerializer(ModelSerializer):
         token.create_token(
             instance=str(settings.CONFIRM_ACCOUNT_PREFIX), user_id=user.id
         )
-        send_mail(
+        outbox.enqueue(
             subject="Activate your account!",
             message=f"Your link to activate is: {token.token()}",
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[
+            recipients=[
                 user.email,
             ],
         )
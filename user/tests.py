@@ -4,6 +4,8 @@ from rest_framework.test import APITestCase
 from django.urls import reverse
 from django.conf import settings
 
+from api.model import OutboxEmail
+
 from .models import User
 from .utils import TokenHandler, CreateMessage
 
@@ -159,6 +161,9 @@ class ForgotPasswordTest(APITestCase):
     def test_send_email_token_pass(self):
         response = self.client.post(self.url, {"email": self.user.email}, format="json")
         self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [self.user.email], OutboxEmail.objects.get().recipients
+        )
 
 
 class ConfirmAccountTest(APITestCase):
@@ -250,6 +255,28 @@ class ChangePassword(APITestCase):
         )
         self.assertEqual(200, response.status_code)
 
+    def test_change_password_token_is_single_use(self):
+        token_handler = TokenHandler()
+        test_token = token_handler.create_token(
+            testing=True, instance=settings.FORGOT_PASSWORD_PREFIX, user_id=self.user.id
+        )
+        data = {"password": "password123456789", "password2": "password123456789"}
+        url = reverse("users:change-password", args=[test_token])
+        self.assertEqual(200, self.client.post(url, data, format="json").status_code)
+        self.assertEqual(400, self.client.post(url, data, format="json").status_code)
+
+    def test_change_password_token_of_other_purpose(self):
+        token_handler = TokenHandler()
+        test_token = token_handler.create_token(
+            testing=True, instance=settings.CONFIRM_ACCOUNT_PREFIX, user_id=self.user.id
+        )
+        response = self.client.post(
+            reverse("users:change-password", args=[test_token]),
+            {"password": "password123456789", "password2": "password123456789"},
+            format="json",
+        )
+        self.assertEqual(400, response.status_code)
+
 
 class TestResponseHandler(TestCase):
     def test_success_message(self):
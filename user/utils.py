@@ -2,29 +2,24 @@ import uuid
 from rest_framework.response import Response
 from rest_framework.serializers import ReturnDict
 
-from django.core.cache import cache
-
-from uuid import uuid4
+from api import tokens
 
 from .models import User
 
 """
 Token generator class
 
-Handles token generation and caching
+Handles signed token generation, validation and revocation
 """
 
 
 class TokenHandler(object):
     __token = None
 
-    def __init__(self):
-        self.__token = str(uuid4())
-
     def create_token(
         self, user_id: int, instance: str, testing: bool = False
     ) -> bool | str:
-        cache.set(instance + self.__token, user_id, timeout=1000 * 60 * 60 * 24 * 3)
+        self.__token = tokens.sign(user_id, instance)
         if testing:
             return self.__token
         return True
@@ -33,11 +28,13 @@ class TokenHandler(object):
         return self.__token
 
     def retrive_token_data(self, token: str, instance: str) -> User:
-        user_id = cache.get(instance + token)
-        return User.objects.filter(id=user_id).first()
+        user_id = tokens.unsign(token, instance)
+        if user_id is None:
+            return None
+        return User.objects.filter(~tokens.revoked(token), id=user_id).first()
 
-    def delete_cached_token(self, token: str, instance: str) -> None:
-        cache.delete(instance + token)
+    def revoke_token(self, token: str) -> None:
+        tokens.revoke(token)
 
 
 """"
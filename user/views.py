@@ -6,11 +6,12 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.contrib.auth import login, logout
 from django.core.cache import cache
 from django.conf import settings
-from django.core.mail import send_mail
 from django.middleware.csrf import get_token
 
 from uuid import uuid4
 
+from api import outbox
+
 from .serializer import (
     LoginSerializer,
     RegisterSerializer,
@@ -90,6 +91,7 @@ class ConfirmAccountView(APIView):
         serializer = ConfirmAccountSerializer(instance=user, data=request.data)
         if serializer.is_valid():
             serializer.save()
+            token_handler.revoke_token(token)
             return CreateMessage.get().create_success_response(
                 "Account activated successfully", status=200
             )
@@ -120,11 +122,10 @@ class ForgotPasswordView(APIView):
             )
         token = TokenHandler()
         token.create_token(user.id, str(settings.FORGOT_PASSWORD_PREFIX))
-        send_mail(
+        outbox.enqueue(
             subject="Reset password!",
             message=f"Your link to reset password is: {token.token()}",
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[
+            recipients=[
                 user.email,
             ],
         )
@@ -153,6 +154,7 @@ class ChangePasswordView(APIView):
         serializer = UpdatePasswordSerializer(user, request.data)
         if serializer.is_valid(raise_exception=True):
             serializer.save()
+            token_handler.revoke_token(token)
             return CreateMessage.get().create_success_response(
                 "Password changed successfully", status=200
             )